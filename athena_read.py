@@ -1,10 +1,22 @@
 # Various functions to read Athena++ output data files
 
 # Python modules
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
 import re
+import shutil
+import tempfile
+import threading
 import warnings
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from io import open  # Consistent binary I/O from Python 2 and 3
-import struct
+from io import BytesIO
+import mmap as mmap_module
 
 import matplotlib.colors as colors
 import matplotlib.patches as patches
@@ -15,6 +27,18 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 check_nan_flag = False
+# keep a sidecar index next to each .bin file, see bin_index()
+bin_index_flag = True
+# parsed-file cache used by cached(): byte budgets of the in-memory and
+# on-disk layers (0 turns a layer off), where the disk layer lives, and
+# whether files are keyed by a hash of their contents instead of their
+# size and modification time
+cache_memory_bytes = 1 << 29
+cache_disk_bytes = 1 << 32
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'athena_read')
+cache_hash_flag = False
+# byte budget of the decoded frames a FrameCache keeps
+frame_cache_bytes = 1 << 30
 
 
 # Check input NumPy array for the presence of any NaN entries
@@ -35,132 +59,311 @@ def error_dat(filename, **kwargs):
     return data
 
 
+# Return the numpy dtype for the dtype keyword of the readers: 'native'
+# keeps the precision of the data on disk, anything else is passed to
+# np.dtype().
+def reader_dtype(dtype, native=np.float64):
+    if isinstance(dtype, str) and dtype == 'native':
+        return np.dtype(native)
+    return np.dtype(dtype)
+
+
 # Read .tab files and return dict.
-def tab(filename, show_vars=False):
+# The file is opened once: the two header lines are parsed as text and the
+# numeric body is converted by numpy in a single call, instead of splitting
+# and converting every line in python.
+# Keyword arguments:
+# columns -- list of headings to return; other columns are not converted
+# (default None, all columns)
+# dtype -- dtype of the returned arrays; text has no on-disk precision so
+# 'native' gives float64 (default np.float64)
+def tab(filename, show_vars=False, columns=None, dtype=np.float64):
 
     # Parse header
     data_dict = {}
-    with open(filename, 'r') as data_file:
-        line = data_file.readline()
+    with open(filename, 'rb') as data_file:
+        line = data_file.readline().decode('ascii')
         attributes = re.search(r'time=(\S+)\s+cycle=(\S+)', line)
-        line = data_file.readline()
+        line = data_file.readline().decode('ascii')
         headings = line.split()[1:]
+        body = data_file.read()
     headings = headings[1:]
+    if show_vars:
+        return list(dict.fromkeys(headings))
 
-    # Go through lines
-    data_array = []
-    num_lines = 0
-    with open(filename, 'r') as data_file:
-        first_line = True
-        for line in data_file:
-            # Skip comments
-            if line.split()[0][0] == '#':
-                continue
-
-            # Extract cell indices
-            vals = line.split()
-            if first_line:
-                num_entries = len(vals) - 1
-                first_line = False
-
-            # Extract cell values
-            vals = vals[1:]
-            data_array.append([float(val) for val in vals])
-            num_lines += 1
-
-    # Reshape array
-    array_shape = (num_lines, num_entries)
-    array_transpose = (1, 0)
-    data_array = np.transpose(np.reshape(data_array, array_shape),
-                              array_transpose)
+    # Select columns, skipping the leading index column
+    headings = select_columns(headings, columns, 'tab')
+    usecols = [n + 1 for n, _ in headings]
 
+    # Convert the cell values of all selected columns at once
+    data_array = np.loadtxt(BytesIO(body), dtype=reader_dtype(dtype), comments='#',
+                            usecols=usecols, ndmin=2).T
 
-    
     # Finalize data
-    for n, heading in enumerate(headings):
+    for n, (_, heading) in enumerate(headings):
         if check_nan_flag:
             check_nan(data_array[n, ...])
         data_dict[heading] = data_array[n, ...]
-    if show_vars:
-        return list(data_dict.keys())
     data_dict['time'] = float(attributes.group(1))
     data_dict['cycle'] = int(attributes.group(2))
     return data_dict
 
 
+# Return (index, name) pairs of the requested columns, in file order.
+# All columns are returned if columns is None.
+def select_columns(names, columns, reader):
+    if columns is None:
+        return [(n, name) for n, name in enumerate(names)
+                if name not in names[:n]]
+    for name in columns:
+        if name not in names:
+            raise RuntimeError('athena_read.{0}: column "{1}" not found; options are {{{2}}}.'
+                               .format(reader, name, ', '.join(names)))
+    return [(n, name) for n, name in enumerate(names)
+            if name in columns and name not in names[:n]]
+
+
 # Read .hst files and return dict of 1D arrays.
+# Only the block after the last header is read: the header is found by
+# scanning backwards from the end of the file, and the rows below it are
+# converted by numpy in one call.
 # Keyword arguments:
 # raw -- if True, do not prune file to remove stale data
 # from prev runs (default False)
-def hst(filename, raw=False):
+# columns -- list of names to return; other columns are not converted
+# (default None, all columns)
+# mmap -- if True, memory-map the file instead of reading it (default False)
+# dtype -- dtype of the returned arrays, as for tab() (default np.float64)
+def hst(filename, raw=False, columns=None, mmap=False, dtype=np.float64):
     # Read data
-    with open(filename, 'r') as data_file:
+    with open(filename, 'rb') as data_file:
+        if mmap:
+            data_file = mmap_module.mmap(data_file.fileno(), 0,
+                                         access=mmap_module.ACCESS_READ)
         # Find header
-        header_found = False
-        multiple_headers = False
-        header_location = None
-        line = data_file.readline()
-        while len(line) > 0:
-            if line == '# Athena++ history data\n':
-                if header_found:
-                    multiple_headers = True
-                else:
-                    header_found = True
-                header_location = data_file.tell()
-            line = data_file.readline()
-        if multiple_headers:
-            warnings.warn('Multiple headers found; using most recent data')
+        data_file.seek(0, 2)
+        header_location = hst_find_header(data_file, data_file.tell())
         if header_location is None:
             raise RuntimeError('athena_read.hst: Could not find header')
+        if header_location > 0:
+            warnings.warn('Multiple headers found; using most recent data')
 
         # Parse header
         data_file.seek(header_location)
-        header = data_file.readline()
+        data_file.readline()
+        header = data_file.readline().decode('ascii')
         data_names = re.findall(r'\[\d+\]=(\S+)', header)
         if len(data_names) == 0:
             raise RuntimeError('athena_read.hst: Could not parse header')
 
-        # Prepare dictionary of results
-        data = {}
-        for name in data_names:
-            data[name] = []
+        # Select columns, time is always needed to prune the data
+        selected = select_columns(data_names, columns, 'hst')
+        if not raw and columns is not None and selected[0][0] != 0:
+            selected.insert(0, (0, data_names[0]))
 
-        # Read data
-        for line in data_file:
-            for name, val in zip(data_names, line.split()):
-                data[name].append(float(val))
+        # Read data, leaving out a partly written last row of a file that
+        # is still being appended to
+        if mmap:
+            rows = data_file[data_file.tell():data_file.rfind(b'\n') + 1]
+            data_file.close()
+        else:
+            rows = data_file.read()
+            if not rows.endswith(b'\n'):
+                rows = rows[:rows.rfind(b'\n') + 1]
+        data = hst_rows(BytesIO(rows), selected, dtype)
 
     # Finalize data
-    for key, val in data.items():
-        data[key] = np.array(val)
     if not raw:
         if data_names[0] != 'time':
             raise AthenaError('Cannot remove spurious data because time '
                               'column could not be identified')
-        branches_removed = False
-        while not branches_removed:
-            branches_removed = True
-            for n in range(1, len(data['time'])):
-                if data['time'][n] <= data['time'][n-1]:
-                    branch_index = np.where((data['time'][:n] >=
-                                             data['time'][n]))[0][0]
-                    for key, val in data.items():
-                        data[key] = np.concatenate((val[:branch_index],
-                                                    val[n:]))
-                    branches_removed = False
-                    break
+        keep = hst_keep(data['time'])
+        if not keep.all():
+            for key, val in data.items():
+                data[key] = val[keep]
+        if columns is not None and 'time' not in columns:
+            del data['time']
         if check_nan_flag:
             for key, val in data.items():
                 check_nan(val)
     return data
 
-# Read .bin files and return dict with numpy array of variables and WCS
-# This is a Z-only code ripped from athenak's plot_slice.py
-# It returns not only all numpy arrays, but also a few meta-data
-# named:   'time', 'xlim', 'ylim'
-def bin(filename, show_vars=False, **kwargs):
-    
-    # Read data
+
+# Return the byte offset of the last history header line in the open
+# file f of the given size, or None.  The file is searched backwards in
+# blocks, so only the tail is read when the last header is near the end.
+# Only the part from offset lower on is searched; lower must be the start
+# of a line.
+def hst_find_header(f, size, block_size=1 << 20, lower=0):
+    marker = b' history data\n'
+    end = size
+    while end > lower:
+        start = max(lower, end - block_size)
+        f.seek(start)
+        # overlap blocks so a header on a block boundary is still found
+        block = f.read(end - start + 64)
+        pos = block.rfind(marker)
+        while pos >= 0:
+            line_start = block.rfind(b'\n', 0, pos) + 1
+            if (line_start > 0 or start == lower) and \
+               re.match(rb'# Athena\S*$', block[line_start:pos]):
+                return start + line_start
+            pos = block.rfind(marker, 0, pos)
+        end = start
+    return None
+
+
+# Convert history rows into a dict of 1D arrays holding the selected
+# (index, name) columns.  rows is anything np.loadtxt reads, and should
+# only hold complete lines.
+def hst_rows(rows, selected, dtype=np.float64):
+    usecols = [n for n, _ in selected]
+    with warnings.catch_warnings():
+        # an empty block is not an error
+        warnings.simplefilter('ignore', UserWarning)
+        table = np.loadtxt(rows, dtype=reader_dtype(dtype), comments='#',
+                           usecols=usecols, ndmin=2)
+    data = {}
+    for n, (_, name) in enumerate(selected):
+        data[name] = table[:, n]
+    return data
+
+
+# Return boolean mask of the history rows that survive a restart.
+# A restart writes rows at times that were already covered, which makes
+# the rows before it stale: a row is kept only if its time is smaller than
+# the time of every row after it.  This is one backward pass over time,
+# equivalent to repeatedly cutting out each branch.
+def hst_keep(time):
+    keep = np.ones(len(time), dtype=bool)
+    if len(time) > 1:
+        later_min = np.minimum.accumulate(time[:0:-1])[::-1]
+        keep[:-1] = time[:-1] < later_min
+    return keep
+
+
+# Follow a .hst file that is still being written.  Every poll() parses
+# only the complete rows appended since the previous poll and returns the
+# dict of 1D arrays that hst() would return for the whole file, with the
+# same pruning of stale data after a restart.  The returned arrays are
+# views into growing buffers, which a later poll may overwrite after a
+# restart; copy them to keep them.
+# Keyword arguments as for hst().
+class HistoryTail:
+
+    def __init__(self, filename, raw=False, columns=None, dtype=np.float64):
+        self.filename = filename
+        self.raw = raw
+        self.columns = columns
+        self.dtype = reader_dtype(dtype)
+        self.reset()
+
+    # forget everything read so far
+    def reset(self):
+        self.inode = None
+        self.offset = 0
+        self.data_names = None
+        self.selected = None
+        self.buffers = {}
+        self.length = 0
+
+    # read the rows appended since the last poll, return all data
+    def poll(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            # not written yet
+            return self.data()
+        size = stat.st_size
+        if size < self.offset or stat.st_ino != self.inode:
+            # the file was truncated or replaced, start over
+            self.reset()
+            self.inode = stat.st_ino
+        if size == self.offset:
+            return self.data()
+
+        with open(self.filename, 'rb') as data_file:
+            # A new header starts a new block of data
+            header_location = hst_find_header(data_file, size, lower=self.offset)
+            if header_location is not None:
+                data_file.seek(header_location)
+                data_file.readline()
+                header = data_file.readline()
+                if not header.endswith(b'\n'):
+                    # wait until the header is complete
+                    self.offset = header_location
+                    return self.data()
+                if header_location > 0:
+                    warnings.warn('Multiple headers found; using most recent data')
+                self.start_block(header.decode('ascii'))
+                self.offset = data_file.tell()
+
+            # Read the complete rows
+            data_file.seek(self.offset)
+            rows = data_file.read(size - self.offset)
+            rows = rows[:rows.rfind(b'\n') + 1]
+            self.offset += len(rows)
+            if self.data_names is not None:
+                self.append(hst_rows(BytesIO(rows), self.selected, self.dtype))
+        return self.data()
+
+    # parse the column names of a new block and drop the old data
+    def start_block(self, header):
+        data_names = re.findall(r'\[\d+\]=(\S+)', header)
+        if len(data_names) == 0:
+            raise RuntimeError('athena_read.HistoryTail: Could not parse header')
+        if not self.raw and data_names[0] != 'time':
+            raise AthenaError('Cannot remove spurious data because time '
+                              'column could not be identified')
+        selected = select_columns(data_names, self.columns, 'HistoryTail')
+        if not self.raw and self.columns is not None and selected[0][0] != 0:
+            selected.insert(0, (0, data_names[0]))
+        self.data_names = data_names
+        self.selected = selected
+        self.buffers = {name: np.empty(0, dtype=self.dtype) for _, name in selected}
+        self.length = 0
+
+    # add new rows, cutting off the rows they make stale
+    def append(self, new):
+        if not self.raw:
+            time = new['time']
+            if len(time) > 0 and self.length > 0:
+                # kept times are increasing, so the stale rows are at the end
+                self.length = np.searchsorted(self.buffers['time'][:self.length],
+                                              time.min())
+            keep = hst_keep(time)
+            if not keep.all():
+                for key, val in new.items():
+                    new[key] = val[keep]
+        num_new = len(new[self.selected[0][1]])
+        length = self.length + num_new
+        for key, val in new.items():
+            if check_nan_flag:
+                check_nan(val)
+            buf = self.buffers.get(key)
+            if buf is None or len(buf) < length:
+                # grow geometrically so appending stays cheap
+                grown = np.empty(max(length, 2 * self.length, 1024), dtype=self.dtype)
+                if buf is not None:
+                    grown[:self.length] = buf[:self.length]
+                self.buffers[key] = buf = grown
+            buf[self.length:length] = val
+        self.length = length
+
+    # current data as views into the buffers
+    def data(self):
+        data = {}
+        for key, buf in self.buffers.items():
+            if self.raw or self.columns is None or key != 'time' or 'time' in self.columns:
+                data[key] = buf[:self.length]
+        return data
+
+
+# Parse the header of a .bin file and the athinput file embedded in it.
+# Returns a dict with the time, cycle, variable names, numpy dtypes of the
+# location and cell data, the input file data, the shape of a meshblock
+# and the offset and size of the block data.
+def bin_header(filename):
     with open(filename, 'rb') as f:
 
         # Get file size
@@ -178,7 +381,8 @@ def bin(filename, show_vars=False, **kwargs):
         if line[:7] != '  time=':
             raise RuntimeError('Could not read time.')
         sim_time = float(line[7:])
-        next(f)
+        line = f.readline().decode('ascii')
+        cycle = int(line[8:]) if line[:8] == '  cycle=' else None
         line = f.readline().decode('ascii')
         if line[:19] != '  size of location=':
             raise RuntimeError('Could not read location size.')
@@ -206,28 +410,6 @@ def bin(filename, show_vars=False, **kwargs):
             raise RuntimeError('Only 4- and 8-byte integer types supported for cell '
                                'data.')
         variable_format = 'f' if variable_size == 4 else 'd'
-        num_variables_base = len(variable_names_base)
-        if show_vars:
-            return variable_names_base
-            
-        if True:
-            variable_name = kwargs['variable']
-            if variable_name not in variable_names_base:
-                raise RuntimeError('Variable "{0}" not found; options are {{{1}}}.'
-                                   .format(variable_name,
-                                           ', '.join(variable_names_base)))
-            variable_names = [variable_name]
-            variable_ind = 0
-            while variable_names_base[variable_ind] != variable_name:
-                variable_ind += 1
-            variable_inds = [variable_ind]
-        variable_names_sorted = \
-            [name for _, name in sorted(zip(variable_inds, variable_names))]
-        variable_inds_sorted = \
-            [ind for ind, _ in sorted(zip(variable_inds, variable_names))]
-
-        # @todo loop over variables
-        retval = {}
 
         # Read input file metadata
         input_data = {}
@@ -249,113 +431,321 @@ def bin(filename, show_vars=False, **kwargs):
         except:  # noqa: E722
             raise RuntimeError('Unable to find number of ghost cells in input file.')
 
-        # Prepare lists to hold results
-        max_level_calculated = -1
-        block_loc_for_level = []
-        block_ind_for_level = []
-        num_blocks_used = 0
-        extents = []
-        quantities = {}
-        for name in variable_names_sorted:
-            quantities[name] = []
-
-        # Go through blocks
-        first_time = True
-        while f.tell() < file_size:
-
-            # Read grid structure data
-            block_indices = np.array(struct.unpack('@6i', f.read(24))) - num_ghost
-            block_i, block_j, block_k, block_level = struct.unpack('@4i', f.read(16))
-
-            # Process grid structure data
-            if first_time:
-                block_nx = block_indices[1] - block_indices[0] + 1
-                block_ny = block_indices[3] - block_indices[2] + 1
-                block_nz = block_indices[5] - block_indices[4] + 1
-                cells_per_block = block_nz * block_ny * block_nx
-                block_cell_format = '=' + str(cells_per_block) + variable_format
-                variable_data_size = cells_per_block * variable_size
-                if True:
-                    # if kwargs['dimension'] == 'z':
-                    if block_nx == 1:
-                        raise RuntimeError('Data in file has no extent in x-direction.')
-                    if block_ny == 1:
-                        raise RuntimeError('Data in file has no extent in y-direction.')
-                    block_nx1 = block_nx
-                    block_nx2 = block_ny
-                    slice_block_n = block_nz
-                    slice_location_min = float(input_data['mesh']['x3min'])
-                    slice_location_max = float(input_data['mesh']['x3max'])
-                    slice_root_blocks = (int(input_data['mesh']['nx3'])
-                                         // int(input_data['meshblock']['nx3']))
-                slice_normalized_coord = (kwargs['location'] - slice_location_min) \
-                    / (slice_location_max - slice_location_min)
-                first_time = False
-
-            # Determine if block is needed
-            if block_level > max_level_calculated:
-                for level in range(max_level_calculated + 1, block_level + 1):
-                    if kwargs['location'] <= slice_location_min:
-                        block_loc_for_level.append(0)
-                        block_ind_for_level.append(0)
-                    elif kwargs['location'] >= slice_location_max:
-                        block_loc_for_level.append(slice_root_blocks - 1)
-                        block_ind_for_level.append(slice_block_n - 1)
-                    else:
-                        slice_mesh_n = slice_block_n * slice_root_blocks * 2 ** level
-                        mesh_ind = int(slice_normalized_coord * slice_mesh_n)
-                        block_loc_for_level.append(mesh_ind // slice_block_n)
-                        block_ind_for_level.append(mesh_ind - slice_block_n
-                                                   * block_loc_for_level[-1])
-                max_level_calculated = block_level
-            # z
-            if block_k != block_loc_for_level[block_level]:
-                f.seek(6 * location_size + num_variables_base * variable_data_size, 1)
-                continue
-            num_blocks_used += 1
-
-            # Read coordinate data
-            block_lims = struct.unpack('=6' + location_format, f.read(6 * location_size))
-            # z
-            extents.append((block_lims[0], block_lims[1], block_lims[2],
-                            block_lims[3]))
-
-            # Read cell data
-            cell_data_start = f.tell()
-            for ind, name in zip(variable_inds_sorted, variable_names_sorted):
-                if ind == -1:
-                    # z
-                    quantities[name].append(np.full((block_ny, block_nx),
-                                                    block_level))
-                else:
-                    f.seek(cell_data_start + ind * variable_data_size, 0)
-                    cell_data = (np.array(struct.unpack(block_cell_format,
-                                                        f.read(variable_data_size)))
-                                 .reshape(block_nz, block_ny, block_nx))
-                    block_ind = block_ind_for_level[block_level]
-                    # z
-                    quantities[name].append(cell_data[block_ind, :, :])
-            f.seek((num_variables_base - ind - 1) * variable_data_size, 1)
-
-    # Prepare to calculate derived quantity
-    for name in variable_names_sorted:
-        quantities[name] = np.array(quantities[name])
+        # The meshblock size follows from the cell indices of the first block
+        f.seek(start_of_data)
+        block_indices = np.frombuffer(f.read(24), dtype=np.intc) - num_ghost
+        if len(block_indices) < 6:
+            raise RuntimeError('No meshblocks found in file.')
+        block_nx = block_indices[1] - block_indices[0] + 1
+        block_ny = block_indices[3] - block_indices[2] + 1
+        block_nz = block_indices[5] - block_indices[4] + 1
+
+    return {'time': sim_time,
+            'cycle': cycle,
+            'variable_names': variable_names_base,
+            'location_dtype': np.dtype(location_format),
+            'variable_dtype': np.dtype(variable_format),
+            'input_data': input_data,
+            'num_ghost': num_ghost,
+            'block_shape': (int(block_nz), int(block_ny), int(block_nx)),
+            'data_offset': start_of_data,
+            'file_size': file_size}
+
+
+# Return the numpy dtype of one meshblock record in a .bin file: 6 cell
+# indices, the logical location and level, the 6 coordinate limits, and
+# the cell data of all variables in their on-disk precision.
+def bin_block_dtype(header):
+    return np.dtype([('indices', np.intc, (6,)),
+                     ('location', np.intc, (4,)),
+                     ('limits', header['location_dtype'], (6,)),
+                     ('data', header['variable_dtype'],
+                      (len(header['variable_names']),) + header['block_shape'])])
+
+
+# Return all meshblocks of a .bin file as a memory-mapped record array
+# (see bin_block_dtype), without reading any cell data.  All meshblocks in
+# a file have the same size, which gives every block a fixed offset.
+def bin_blocks(filename, header=None):
+    if header is None:
+        header = bin_header(filename)
+    block_dtype = bin_block_dtype(header)
+    data_size = header['file_size'] - header['data_offset']
+    if data_size % block_dtype.itemsize != 0:
+        raise RuntimeError('Meshblocks in file do not all have the same size.')
+    return np.memmap(filename, dtype=block_dtype, mode='r',
+                     offset=header['data_offset'],
+                     shape=(data_size // block_dtype.itemsize,))
+
+
+# Return the header of a .bin file (see bin_header) together with its
+# block table: 'offsets' (byte offset of each meshblock), 'location'
+# (logical location and level) and 'limits' (coordinate limits).  These
+# are kept in a sidecar index filename + '.idx', which is used as long
+# as the size and modification time of the file match, so the ASCII
+# header and the block headers are not parsed again.
+def bin_index(filename):
+    stat = os.stat(filename)
+    index_file = filename + '.idx'
+    if bin_index_flag:
+        try:
+            with np.load(index_file, allow_pickle=False) as index:
+                if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime_ns:
+                    header = json.loads(str(index['header']))
+                    header['location_dtype'] = np.dtype(header['location_dtype'])
+                    header['variable_dtype'] = np.dtype(header['variable_dtype'])
+                    header['block_shape'] = tuple(header['block_shape'])
+                    header['offsets'] = index['offsets']
+                    header['location'] = index['location']
+                    header['limits'] = index['limits']
+                    return header
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # missing, stale or unreadable index, it is written again below
+            pass
+
+    # Parse the file and walk all block headers
+    header = bin_header(filename)
+    blocks = bin_blocks(filename, header)
+    offsets = header['data_offset'] + \
+        blocks.dtype.itemsize * np.arange(len(blocks), dtype=np.int64)
+    location = np.array(blocks['location'])
+    limits = np.array(blocks['limits'])
+    del blocks
+
+    if bin_index_flag:
+        saved = dict(header)
+        saved['location_dtype'] = header['location_dtype'].char
+        saved['variable_dtype'] = header['variable_dtype'].char
+        try:
+            # write under a temporary name of its own, so readers never see
+            # half an index and threads indexing the same file at once do
+            # not cut each other short
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(index_file) or '.',
+                                       prefix=os.path.basename(index_file) + '.',
+                                       suffix='.tmp')
+        except OSError:
+            # read-only directory, go without index
+            pass
+        else:
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, header=json.dumps(saved), size=stat.st_size,
+                             mtime=stat.st_mtime_ns, offsets=offsets,
+                             location=location, limits=limits)
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, index_file)
+            except OSError:
+                remove_quietly(tmp)
+
+    header['offsets'] = offsets
+    header['location'] = location
+    header['limits'] = limits
+    return header
+
+
+# Place meshblocks into one preallocated array (float64 by default)
+# covering all of them.  cells holds the blocks, shaped (num_blocks, ...) with the cell
+# axes in (z,) y, x order; logical holds the logical (k,) j, i location of
+# each block in the same order.  Cells of positions without a block are
+# NaN.  All blocks are written with one fancy-indexed assignment.
+# If out is given the blocks are written into it instead, at their
+# logical location counted from the origin of out.
+def bin_assemble(cells, logical, dtype=np.float64, out=None):
+    cell_shape = cells.shape[1:]
+    ndim = len(cell_shape)
+    if out is None:
+        logical = np.asarray(logical) - np.min(logical, axis=0)
+        counts = tuple(int(c) for c in np.max(logical, axis=0) + 1)
+        shape = tuple(c * n for c, n in zip(counts, cell_shape))
+        if len(cells) == np.prod(counts):
+            out = np.empty(shape, dtype=dtype)
+        else:
+            out = np.full(shape, np.nan, dtype=dtype)
+    else:
+        counts = tuple(s // n for s, n in zip(out.shape, cell_shape))
+    # view as (blocks_z, nz, blocks_y, ny, ...), then order the block axes first
+    interleaved = out.reshape([n for pair in zip(counts, cell_shape) for n in pair])
+    blocks_first = interleaved.transpose(list(range(0, 2 * ndim, 2)) +
+                                         list(range(1, 2 * ndim, 2)))
+    blocks_first[tuple(np.asarray(logical).T)] = cells
+    return out
+
+
+# Resample meshblocks of different refinement levels onto one uniform
+# array of the given shape at refinement level `level`.  cells and
+# logical are as for bin_assemble, block_level holds the level of each
+# block.  Coarser blocks are prolonged by repeating cells, finer blocks
+# are restricted by averaging cells; both are done for all blocks of a
+# level at once.  Axes of one cell are not refined.  Averages are taken in
+# float64 and the result is stored with the given dtype.
+def bin_resample(cells, logical, block_level, level, shape, dtype=np.float64):
+    out = np.full(shape, np.nan, dtype=dtype)
+    cell_shape = cells.shape[1:]
+    refined = [d for d, n in enumerate(cell_shape) if n > 1]
+    for block_level_n in np.unique(block_level):
+        selected = block_level == block_level_n
+        level_cells = cells[selected]
+        if block_level_n < level:
+            factor = 2 ** (level - block_level_n)
+            for d in refined:
+                level_cells = np.repeat(level_cells, factor, axis=d + 1)
+        elif block_level_n > level:
+            factor = 2 ** (block_level_n - level)
+            if any(cell_shape[d] % factor for d in refined):
+                raise RuntimeError('Meshblocks at level {0} are too small to restrict '
+                                   'to level {1}.'.format(block_level_n, level))
+            split = [len(level_cells)]
+            for d, n in enumerate(cell_shape):
+                split += [n // factor, factor] if d in refined else [n, 1]
+            level_cells = level_cells.reshape(split) \
+                .mean(axis=tuple(range(2, len(split), 2)), dtype=np.float64)
+        bin_assemble(level_cells, np.asarray(logical)[selected], out=out)
+    return out
+
+
+# Return the axis (1, 2 or 3) normal to a slice given as 'x', 'y', 'z' or
+# 'x1', 'x2', 'x3'
+def bin_slice_axis(dimension):
+    axes = {'x': 1, 'y': 2, 'z': 3, 'x1': 1, 'x2': 2, 'x3': 3}
+    if dimension not in axes:
+        raise RuntimeError('Slice dimension "{0}" not understood; options are x, y, z.'
+                           .format(dimension))
+    return axes[dimension]
+
+
+# Return the axes (a, h, v) of a slice: a normal to it, and h and v drawn
+# horizontally and vertically in its image
+def bin_slice_plane(dimension):
+    a = bin_slice_axis(dimension)
+    h, v = [axis for axis in (1, 2, 3) if axis != a]
+    return a, h, v
+
+
+# Read .bin files and return dict with numpy array of variables and WCS
+# This code started out from athenak's plot_slice.py
+# It slices normal to the x, y or z axis (the dimension keyword, default
+# z) at the given location, and returns not only all numpy arrays, but
+# also a few meta-data named:   'time', 'cycle', 'xlim', 'ylim'
+# xlim and ylim are the horizontal and vertical extent of the slice, which
+# for an x slice are y and z, and for a y slice x and z.
+# The variable keyword can be one name, a list of names or 'all'; the
+# first one is plotted if an output_file is given.
+# The dtype keyword sets the dtype of the returned arrays: default float64,
+# 'native' keeps the single or double precision of the file.
+# The meshblocks are memory-mapped, so only the cells of the slice are
+# read from the file and no per-cell python objects are made.
+def bin(filename, show_vars=False, **kwargs):
+
+    # Read header metadata
+    header = bin_index(filename)
+    sim_time = header['time']
+    variable_names_base = header['variable_names']
+    input_data = header['input_data']
+    if show_vars:
+        return variable_names_base
+    dtype = reader_dtype(kwargs.get('dtype', np.float64), header['variable_dtype'])
+
+    # One variable, a list of them, or 'all'
+    variable_names = kwargs['variable']
+    if variable_names == 'all':
+        variable_names = variable_names_base
+    elif isinstance(variable_names, str):
+        variable_names = [variable_names]
+    for variable_name in variable_names:
+        if variable_name not in variable_names_base:
+            raise RuntimeError('Variable "{0}" not found; options are {{{1}}}.'
+                               .format(variable_name,
+                                       ', '.join(variable_names_base)))
+    variable_name = variable_names[0]
+    variable_inds = np.array([variable_names_base.index(name)
+                              for name in variable_names])
+
+    # Process grid structure data
+    # The slice is normal to axis a (1, 2 or 3 for x, y or z); the image
+    # has axis h horizontally and axis v vertically
+    blocks = bin_blocks(filename, header)
+    a, h, v = bin_slice_plane(kwargs.get('dimension', 'z'))
+    block_n = header['block_shape'][::-1]
+    for axis in (h, v):
+        if block_n[axis - 1] == 1:
+            raise RuntimeError('Data in file has no extent in {0}-direction.'
+                               .format('xyz'[axis - 1]))
+    slice_block_n = block_n[a - 1]
+    slice_location_min = float(input_data['mesh']['x%dmin' % a])
+    slice_location_max = float(input_data['mesh']['x%dmax' % a])
+    slice_root_blocks = (int(input_data['mesh']['nx%d' % a])
+                         // int(input_data['meshblock']['nx%d' % a]))
+    slice_normalized_coord = (kwargs['location'] - slice_location_min) \
+        / (slice_location_max - slice_location_min)
+
+    # Determine which blocks are needed, and the cell plane in each of them
+    block_level = header['location'][:, 3]
+    block_loc_for_level = []
+    block_ind_for_level = []
+    for level in range(block_level.max() + 1):
+        # without extent along the slice axis (a 2D mesh) blocks are not
+        # refined in that direction, every level has location and plane 0
+        if slice_block_n == 1 or kwargs['location'] <= slice_location_min:
+            block_loc_for_level.append(0)
+            block_ind_for_level.append(0)
+        elif kwargs['location'] >= slice_location_max:
+            block_loc_for_level.append(slice_root_blocks * 2 ** level - 1)
+            block_ind_for_level.append(slice_block_n - 1)
+        else:
+            slice_mesh_n = slice_block_n * slice_root_blocks * 2 ** level
+            mesh_ind = int(slice_normalized_coord * slice_mesh_n)
+            block_loc_for_level.append(mesh_ind // slice_block_n)
+            block_ind_for_level.append(mesh_ind - slice_block_n
+                                       * block_loc_for_level[-1])
+    used = np.flatnonzero(header['location'][:, a - 1] ==
+                          np.array(block_loc_for_level)[block_level])
+    num_blocks_used = len(used)
+    block_ind = np.array(block_ind_for_level)[block_level[used]]
+
+    # Read coordinate data
+    hv_limits = header['limits'][used][:, [2 * h - 2, 2 * h - 1, 2 * v - 2, 2 * v - 1]]
+    extents = [tuple(lims) for lims in hv_limits.tolist()]
+
+    # Read cell data of all variables in one pass over the blocks, only
+    # the planes of the slice are touched; the cell axes are z, y, x so
+    # the result is shaped (block, variable, v, h)
+    index = [used[:, None], variable_inds[None, :], slice(None), slice(None), slice(None)]
+    index[5 - a] = block_ind[:, None]
+    planes = blocks['data'][tuple(index)]
+
+    # Blocks at a single refinement level are placed into one array that
+    # covers them all; slices through a refined mesh are resampled onto
+    # the finest level they cut, or drawn block by block
+    used_level = block_level[used]
+    assembled = num_blocks_used > 0 and (used_level == used_level[0]).all()
+    logical = header['location'][used][:, [v - 1, h - 1]]
+    quantities = {}
+    for n, name in enumerate(variable_names):
+        if assembled:
+            quantities[name] = bin_assemble(planes[:, n], logical, dtype)
+        elif kwargs['output_file'] == None:
+            max_level = used_level.max()
+            shape = tuple(int(input_data['mesh']['nx%d' % axis]) * 2 ** max_level
+                          for axis in (v, h))
+            quantities[name] = bin_resample(planes[:, n], logical, used_level,
+                                            max_level, shape, dtype)
+        else:
+            quantities[name] = planes[:, n].astype(dtype)
 
     # Extract quantity without derivation
     quantity = quantities[variable_name]
 
     if kwargs['output_file'] == None:
-        if num_blocks_used > 1:
-            raise RuntimeError('too many blocks, mesh and meshblock not the same')
         quantities['time'] = sim_time
+        quantities['cycle'] = header['cycle']
 
-        x1_min = float(input_data['mesh']['x1min'])
-        x1_max = float(input_data['mesh']['x1max'])
-        x2_min = float(input_data['mesh']['x2min'])
-        x2_max = float(input_data['mesh']['x2max'])
+        x1_min = float(hv_limits[:, 0].min())
+        x1_max = float(hv_limits[:, 1].max())
+        x2_min = float(hv_limits[:, 2].min())
+        x2_max = float(hv_limits[:, 3].max())
         quantities['xlim'] = (x1_min,x1_max)
         quantities['ylim'] = (x2_min,x2_max)
-            
+
         return quantities
 
     # Calculate colors
@@ -388,22 +778,25 @@ def bin(filename, show_vars=False, **kwargs):
     dpi = 300
     
     # Plot data
-    for block_num in range(num_blocks_used):
-        d = quantity[block_num]
-        print("block_num:",block_num,d.shape,extents[block_num])
-        
-        plt.imshow(quantity[block_num], cmap=kwargs['cmap'], norm=norm, vmin=vmin,
+    if assembled:
+        extent = (hv_limits[:, 0].min(), hv_limits[:, 1].max(),
+                  hv_limits[:, 2].min(), hv_limits[:, 3].max())
+        plt.imshow(quantity, cmap=kwargs['cmap'], norm=norm, vmin=vmin,
                    vmax=vmax, interpolation='none', origin='lower',
-                   extent=extents[block_num])
+                   extent=extent)
+    else:
+        for block_num in range(num_blocks_used):
+            plt.imshow(quantity[block_num], cmap=kwargs['cmap'], norm=norm, vmin=vmin,
+                       vmax=vmax, interpolation='none', origin='lower',
+                       extent=extents[block_num])
     # Make colorbar
     plt.colorbar()
 
     # Adjust axes
-    # z
-    x1_min = float(input_data['mesh']['x1min'])
-    x1_max = float(input_data['mesh']['x1max'])
-    x2_min = float(input_data['mesh']['x2min'])
-    x2_max = float(input_data['mesh']['x2max'])
+    x1_min = float(input_data['mesh']['x%dmin' % h])
+    x1_max = float(input_data['mesh']['x%dmax' % h])
+    x2_min = float(input_data['mesh']['x%dmin' % v])
+    x2_max = float(input_data['mesh']['x%dmax' % v])
     print("Mesh:  X: %g %g    Y: %g %g" % (x1_min,x1_max,x2_min,x2_max))
     if kwargs['x1_min'] is not None:
         x1_min = kwargs['x1_min']
@@ -415,9 +808,8 @@ def bin(filename, show_vars=False, **kwargs):
         x2_max = kwargs['x2_max']
     plt.xlim((x1_min, x1_max))
     plt.ylim((x2_min, x2_max))
-    # z
-    plt.xlabel('$x$', labelpad=x1_labelpad)
-    plt.ylabel('$y$', labelpad=x2_labelpad)
+    plt.xlabel('$%s$' % 'xyz'[h - 1], labelpad=x1_labelpad)
+    plt.ylabel('$%s$' % 'xyz'[v - 1], labelpad=x2_labelpad)
     
     # Adjust layout
     plt.tight_layout()
@@ -430,6 +822,853 @@ def bin(filename, show_vars=False, **kwargs):
         plt.show()
 
 
+# Return full 3D fields of a .bin file without reading them into memory.
+# The dict holds one (nz, ny, nx) array per variable (one name, a list of
+# names, or 'all'), in the on-disk precision, plus 'time' and the mesh
+# extent 'xlim', 'ylim', 'zlim'.  For a mesh of one meshblock each array
+# is an np.memmap view into the file; for more meshblocks it is a
+# BinVolume, which only reads the blocks needed when it is indexed.
+def bin_volume(filename, variable='all'):
+    header = bin_index(filename)
+    variable_names_base = header['variable_names']
+    variable_names = variable
+    if variable_names == 'all':
+        variable_names = variable_names_base
+    elif isinstance(variable_names, str):
+        variable_names = [variable_names]
+    for variable_name in variable_names:
+        if variable_name not in variable_names_base:
+            raise RuntimeError('Variable "{0}" not found; options are {{{1}}}.'
+                               .format(variable_name,
+                                       ', '.join(variable_names_base)))
+    block_level = header['location'][:, 3]
+    if (block_level != block_level[0]).any():
+        raise RuntimeError('Meshblocks at different refinement levels can not be '
+                           'assembled into one array; use bin_levels().')
+
+    blocks = bin_blocks(filename, header)
+    volumes = {}
+    for name in variable_names:
+        ind = variable_names_base.index(name)
+        if len(blocks) == 1:
+            volumes[name] = blocks['data'][0, ind]
+        else:
+            volumes[name] = BinVolume(blocks, ind, header['location'][:, [2, 1, 0]])
+    limits = header['limits']
+    volumes['time'] = header['time']
+    volumes['xlim'] = (float(limits[:, 0].min()), float(limits[:, 1].max()))
+    volumes['ylim'] = (float(limits[:, 2].min()), float(limits[:, 3].max()))
+    volumes['zlim'] = (float(limits[:, 4].min()), float(limits[:, 5].max()))
+    return volumes
+
+
+# Read .bin files of a refined mesh and return the meshblocks grouped by
+# refinement level.  The dict holds 'time', 'variable_names', 'block_shape'
+# (nz, ny, nx of a meshblock), 'root_shape' (nz, ny, nx of the root mesh)
+# and 'levels', which maps each level to a dict with the 'logical' (k, j, i)
+# location and 'extents' (x1min, x1max, x2min, x2max, x3min, x3max) of its
+# blocks, and an array (block, nz, ny, nx) of cells per variable in the
+# on-disk precision.  See bin_uniform() to resample them onto one grid.
+def bin_levels(filename, variable='all'):
+    header = bin_index(filename)
+    variable_names_base = header['variable_names']
+    variable_names = variable
+    if variable_names == 'all':
+        variable_names = variable_names_base
+    elif isinstance(variable_names, str):
+        variable_names = [variable_names]
+    variable_inds = [variable_names_base.index(name) for name in variable_names]
+    mesh = header['input_data']['mesh']
+
+    blocks = bin_blocks(filename, header)
+    block_level = header['location'][:, 3]
+    levels = {}
+    for level in np.unique(block_level).tolist():
+        selected = np.flatnonzero(block_level == level)
+        cells = blocks['data'][selected[:, None], np.array(variable_inds)[None, :]]
+        levels[level] = {'logical': header['location'][selected][:, [2, 1, 0]],
+                         'extents': np.array(header['limits'][selected])}
+        for n, name in enumerate(variable_names):
+            levels[level][name] = cells[:, n]
+    return {'time': header['time'],
+            'variable_names': variable_names,
+            'block_shape': header['block_shape'],
+            'root_shape': tuple(int(mesh['nx%d' % axis]) for axis in (3, 2, 1)),
+            'levels': levels}
+
+
+# Resample one variable of the result of bin_levels() onto a uniform
+# (nz, ny, nx) grid at the given refinement level (default the finest),
+# see bin_resample().  dtype is float64 by default, 'native' keeps the
+# precision of the file.
+def bin_uniform(amr, variable, level=None, dtype=np.float64):
+    levels = amr['levels']
+    if level is None:
+        level = max(levels)
+    names = sorted(levels)
+    cells = np.concatenate([levels[n][variable] for n in names])
+    logical = np.concatenate([levels[n]['logical'] for n in names])
+    block_level = np.concatenate([np.full(len(levels[n]['logical']), n) for n in names])
+    shape = tuple(n * 2 ** level if b > 1 else n
+                  for n, b in zip(amr['root_shape'], amr['block_shape']))
+    return bin_resample(cells, logical, block_level, level, shape,
+                        reader_dtype(dtype, cells.dtype))
+
+
+# A 3D field spread over the meshblocks of a .bin file that is only
+# gathered when indexed.  It supports basic indexing (integers, slices
+# and Ellipsis); only the meshblocks that intersect the selection are read.
+# np.asarray() on it reads the whole field.
+class BinVolume:
+
+    def __init__(self, blocks, variable_ind, logical):
+        self.blocks = blocks
+        self.variable_ind = variable_ind
+        self.logical = logical - logical.min(axis=0)
+        self.block_shape = blocks.dtype['data'].shape[1:]
+        self.shape = tuple(int(n) * (int(b) + 1) for n, b in
+                           zip(self.block_shape, self.logical.max(axis=0)))
+        self.dtype = blocks.dtype['data'].base
+        self.ndim = 3
+        self.size = int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'BinVolume(shape={0}, dtype={1}, blocks={2})'.format(
+            self.shape, self.dtype, len(self.blocks))
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        # Normalize key to one slice per axis
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            n = key.index(Ellipsis)
+            key = key[:n] + (slice(None),) * (4 - len(key)) + key[n + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+        if len(key) != 3:
+            raise IndexError('too many indices for BinVolume')
+        ranges = []
+        squeeze = []
+        for axis, k in enumerate(key):
+            if isinstance(k, (int, np.integer)):
+                if not -self.shape[axis] <= k < self.shape[axis]:
+                    raise IndexError('index {0} is out of bounds for axis {1} with size {2}'
+                                     .format(k, axis, self.shape[axis]))
+                k = slice(k % self.shape[axis], k % self.shape[axis] + 1)
+                squeeze.append(axis)
+            elif not isinstance(k, slice):
+                raise IndexError('BinVolume only supports integers, slices and Ellipsis')
+            ranges.append(range(*k.indices(self.shape[axis])))
+        if any(len(r) == 0 for r in ranges):
+            return np.empty([len(r) for r in ranges], dtype=self.dtype) \
+                .squeeze(axis=tuple(squeeze))
+
+        # Read the blocks that intersect the selection
+        lo = np.array([min(r[0], r[-1]) for r in ranges])
+        hi = np.array([max(r[0], r[-1]) for r in ranges])
+        n = np.array(self.block_shape)
+        inside = ((self.logical >= lo // n) & (self.logical <= hi // n)).all(axis=1)
+        used = np.flatnonzero(inside)
+        cells = self.blocks['data'][used, self.variable_ind]
+        data = bin_assemble(cells, self.logical[used], dtype=self.dtype)
+
+        # Cut the selection out of the assembled blocks
+        origin = self.logical[used].min(axis=0) * n
+        local = []
+        for r, base in zip(ranges, origin):
+            stop = r[-1] - base + (1 if r.step > 0 else -1)
+            local.append(slice(r[0] - base, stop if stop >= 0 else None, r.step))
+        return data[tuple(local)].squeeze(axis=tuple(squeeze))
+
+
+# Mip-map pyramid of a 2D image: the image followed by versions with half
+# the resolution of the one before, each cell the mean of 2x2 cells (the
+# last row or column is repeated for odd sizes), down to min_size cells
+# on the longer side.
+def image_pyramid(image, min_size=256):
+    levels = [image]
+    while max(levels[-1].shape) > min_size and min(levels[-1].shape) >= 2:
+        level = levels[-1]
+        ny, nx = level.shape
+        if ny % 2 or nx % 2:
+            level = np.pad(level, ((0, ny % 2), (0, nx % 2)), mode='edge')
+        levels.append(level.reshape(level.shape[0] // 2, 2, level.shape[1] // 2, 2)
+                      .mean(axis=(1, 3), dtype=level.dtype))
+    return levels
+
+
+# Read a slice of a .bin file like bin() and add an image pyramid of every
+# variable (see image_pyramid()): level n of variable v is under 'v.n',
+# level 0 is the slice itself under 'v'.  'levels' is the number of levels.
+# Viewers draw the level that matches the screen resolution instead of
+# the full slice.
+def bin_pyramid(filename, min_size=256, **kwargs):
+    data = bin(filename, **kwargs)
+    if not isinstance(data, dict):
+        return data
+    for key in [key for key, val in data.items() if isinstance(val, np.ndarray) and val.ndim == 2]:
+        levels = image_pyramid(data[key], min_size)
+        for n, level in enumerate(levels[1:]):
+            data['{0}.{1}'.format(key, n + 1)] = level
+        data['levels'] = len(levels)
+    return data
+
+
+# Axis limits (low, high) widened by margin of their span on both sides,
+# as autoscaling pads the data range.  A range without span (a constant
+# column) or with non-finite ends is opened up first, so the limits can
+# always be set.
+def padded_limits(lim, margin):
+    lo, hi = sorted(float(val) for val in lim)
+    if not (np.isfinite(lo) and np.isfinite(hi)):
+        lo, hi = -0.001, 0.001
+    elif hi - lo <= 1e-15 * max(abs(lo), abs(hi)):
+        if lo == hi == 0.0:
+            lo, hi = -0.001, 0.001
+        else:
+            lo, hi = lo - 0.001 * abs(lo), hi + 0.001 * abs(hi)
+    return lo - margin * (hi - lo), hi + margin * (hi - lo)
+
+
+# Reduce a line with sorted x to at most 4 points per pixel column for
+# drawing: the first, last, lowest and highest point of each of width
+# equal bins of x (within xlim if given, plus the points just outside),
+# so peaks and shocks survive.  Lines that are short enough, or whose x
+# is not sorted, are returned as they are.
+def decimate_line(x, y, width, xlim=None):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) < 2 or x[0] > x[-1]:
+        if len(x) >= 2 and np.all(x[:-1] >= x[1:]):
+            xd, yd = decimate_line(x[::-1], y[::-1], width, xlim)
+            return xd[::-1], yd[::-1]
+        return x, y
+    if len(x) <= 4 * width or np.any(x[:-1] > x[1:]):
+        return x, y
+    lo, hi = (x[0], x[-1]) if xlim is None else sorted(xlim)
+    first = max(int(np.searchsorted(x, lo, side='left')) - 1, 0)
+    last = min(int(np.searchsorted(x, hi, side='right')) + 1, len(x))
+    x = x[first:last]
+    y = y[first:last]
+    if len(x) <= 4 * width or hi <= lo:
+        return x, y
+
+    # bins are contiguous runs of the sorted points
+    edges = lo + (hi - lo) * np.arange(1, width) / width
+    starts = np.unique(np.concatenate(([0], np.searchsorted(x, edges))))
+    starts = starts[starts < len(x)]
+    ends = np.append(starts[1:], len(x))
+    index = np.arange(len(x))
+    # first points of the lowest and highest values of each bin, NaNs skipped
+    bin_of = np.repeat(np.arange(len(starts)), ends - starts)
+    low = np.fmin.reduceat(y, starts)
+    high = np.fmax.reduceat(y, starts)
+    at_low = np.minimum.reduceat(np.where(y == low[bin_of], index, len(x)), starts)
+    at_high = np.minimum.reduceat(np.where(y == high[bin_of], index, len(x)), starts)
+    keep = np.unique(np.concatenate((starts, ends - 1,
+                                     np.minimum(at_low, ends - 1),
+                                     np.minimum(at_high, ends - 1))))
+    return x[keep], y[keep]
+
+
+# Return the sorted snapshot files of one kind ('tab' or 'bin') of a run
+# directory: athena++/athenak keep them in a tab/ or bin/ subdirectory,
+# athenac in the run directory itself.
+def run_files(rundir, kind):
+    if os.path.isdir(os.path.join(rundir, kind)):
+        rundir = os.path.join(rundir, kind)
+    return sorted(glob.glob(os.path.join(rundir, '*.' + kind)))
+
+
+# Return the directory of the columnar store of a list of snapshot files.
+def store_path(files, kind):
+    return os.path.join(os.path.dirname(files[0]), kind + '.store')
+
+
+# Size and modification time of the snapshot files, to tell if a store
+# still matches them.
+def store_sources(files):
+    sources = []
+    for name in files:
+        stat = os.stat(name)
+        sources.append([os.path.basename(name), stat.st_size, stat.st_mtime_ns])
+    return sources
+
+
+# Pack the tab or bin snapshots of a run directory into one columnar
+# store next to them: one <variable>.npy per variable shaped [frame, ...],
+# frames.npy with the time and cycle of every frame, and store.json with
+# the variable names and the files it was made from.  bin snapshots are
+# stored as the slice given by dimension and location, as bin() returns
+# it.  All arrays are written frame by frame and can be memory-mapped.
+# The snapshots are decoded a batch at a time on worker processes (one
+# per core by default), see load_many().  Returns the path of the store.
+def store_run(rundir, kind, dimension='z', location=0.0, dtype='native', workers=None):
+    files = run_files(rundir, kind)
+    if len(files) == 0:
+        raise RuntimeError('No {0} files found in {1}.'.format(kind, rundir))
+    path = store_path(files, kind)
+    os.makedirs(path, exist_ok=True)
+    meta_file = os.path.join(path, 'store.json')
+    if os.path.exists(meta_file):
+        # the store is incomplete until store.json is written again
+        os.remove(meta_file)
+    meta = {'kind': kind, 'sources': store_sources(files)}
+    if kind == 'bin':
+        meta['dimension'] = dimension
+        meta['location'] = location
+
+    if kind == 'tab':
+        reader, kwargs = tab, {'dtype': dtype}
+    else:
+        reader, kwargs = bin, {'variable': 'all', 'dimension': dimension,
+                               'location': location, 'output_file': None, 'dtype': dtype}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # a few frames per worker are decoded at a time
+    batch = 4 * max(1, workers)
+    decoded = (data for start in range(0, len(files), batch)
+               for data in load_many(reader, files[start:start + batch], workers, **kwargs))
+
+    arrays = {}
+    frames = np.zeros(len(files), dtype=[('time', np.float64), ('cycle', np.int64)])
+    for i, (name, data) in enumerate(zip(files, decoded)):
+        cycle = data.pop('cycle')
+        if kind == 'bin':
+            meta['xlim'] = data.pop('xlim')
+            meta['ylim'] = data.pop('ylim')
+        frames[i] = (data.pop('time'), cycle)
+        if i == 0:
+            meta['variables'] = list(data)
+            for key, val in data.items():
+                arrays[key] = np.lib.format.open_memmap(
+                    os.path.join(path, key + '.npy'), mode='w+', dtype=val.dtype,
+                    shape=(len(files),) + val.shape)
+        for key, val in data.items():
+            if val.shape != arrays[key].shape[1:]:
+                raise RuntimeError('Frame {0} has a different shape than the first frame.'
+                                   .format(name))
+            arrays[key][i] = val
+    for key in arrays:
+        arrays[key].flush()
+    del arrays
+    np.save(os.path.join(path, 'frames.npy'), frames)
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+    return path
+
+
+# Open the columnar store of the tab or bin snapshots of a run directory
+# (see store_run), or return None if there is none or it no longer matches
+# the snapshot files.  The dict holds a memory-mapped [frame, ...] array
+# per variable, 'time' and 'cycle' arrays, 'variables', and for bin files
+# 'xlim' and 'ylim'.  bin stores are only used for the same slice.
+def open_store(rundir, kind, dimension='z', location=0.0):
+    files = run_files(rundir, kind)
+    if len(files) == 0:
+        return None
+    path = store_path(files, kind)
+    try:
+        with open(os.path.join(path, 'store.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta['sources'] != store_sources(files):
+        return None
+    if kind == 'bin' and (meta['dimension'] != dimension or meta['location'] != location):
+        return None
+
+    store = {}
+    for key in meta['variables']:
+        store[key] = np.load(os.path.join(path, key + '.npy'), mmap_mode='r')
+    frames = np.load(os.path.join(path, 'frames.npy'))
+    store['time'] = frames['time']
+    store['cycle'] = frames['cycle']
+    store['variables'] = meta['variables']
+    if kind == 'bin':
+        store['xlim'] = tuple(meta['xlim'])
+        store['ylim'] = tuple(meta['ylim'])
+    return store
+
+
+# Cache key of a reader call: the reader, the arguments and either the
+# path, size and modification time of the file or a hash of its contents.
+def cache_key(reader, filename, kwargs):
+    stat = os.stat(filename)
+    if cache_hash_flag:
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                digest.update(block)
+        source = [digest.hexdigest(), stat.st_size]
+    else:
+        source = [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+    args = sorted((key, repr(val)) for key, val in kwargs.items())
+    return hashlib.sha1(json.dumps([reader.__name__, source, args]).encode()).hexdigest()
+
+
+# Bytes held by the arrays of a parsed result
+def cache_size(data):
+    return sum(val.nbytes for val in data.values() if isinstance(val, np.ndarray))
+
+
+# Write a parsed result to the disk cache as an .npz archive: arrays as
+# they are, everything else (times, cycles, limits) in a JSON entry.
+def cache_write(path, data):
+    arrays = {}
+    meta = {}
+    for key, val in data.items():
+        if isinstance(val, np.ndarray):
+            arrays[key] = np.asarray(val)
+        elif isinstance(val, tuple):
+            meta[key] = ['tuple', [v.item() if isinstance(v, np.generic) else v for v in val]]
+        else:
+            meta[key] = ['value', val.item() if isinstance(val, np.generic) else val]
+    arrays['__meta__'] = np.array(json.dumps([list(data), meta]))
+    # a temporary file of its own, so writers of the same entry in other
+    # threads or processes do not cut each other short
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+    except BaseException:
+        remove_quietly(tmp)
+        raise
+
+
+def cache_read(path):
+    with np.load(path, allow_pickle=False) as archive:
+        keys, meta = json.loads(str(archive['__meta__']))
+        data = {}
+        for key in keys:
+            if key not in meta:
+                data[key] = archive[key]
+            elif meta[key][0] == 'tuple':
+                data[key] = tuple(meta[key][1])
+            else:
+                data[key] = meta[key][1]
+    return data
+
+
+# Read an entry of the disk cache, or return None if there is none.  An
+# entry that can not be read (cut short or corrupt) is removed.
+def cache_open(path):
+    try:
+        return cache_read(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        remove_quietly(path)
+        return None
+
+
+# Remove a file if it is there
+def remove_quietly(name):
+    try:
+        os.remove(name)
+    except OSError:
+        pass
+
+
+# Remove the least recently used files of the disk cache until it fits in
+# cache_disk_bytes.  Hits refresh the modification time of their file.
+def cache_evict_disk():
+    entries = []
+    for name in glob.glob(os.path.join(cache_dir, '*.npz')):
+        try:
+            stat = os.stat(name)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, name))
+    total = sum(entry[1] for entry in entries)
+    for _, size, name in sorted(entries):
+        if total <= cache_disk_bytes:
+            break
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+        total -= size
+
+
+# In-memory layer: key -> (parsed result, bytes), least recently used first.
+# The lock makes it safe to read through the cache from several threads.
+cache_memory = OrderedDict()
+cache_lock = threading.Lock()
+
+
+def cache_clear(disk=False):
+    with cache_lock:
+        cache_memory.clear()
+    if disk:
+        for name in glob.glob(os.path.join(cache_dir, '*.npz')):
+            os.remove(name)
+
+
+# Call reader(filename, **kwargs) (tab, hst or bin) through the parsed-file
+# cache.  Results are looked up in memory, then on disk in cache_dir, and
+# only parsed on a miss.  Both layers drop their least recently used
+# entries to stay within cache_memory_bytes and cache_disk_bytes.  Only
+# dict results are cached; anything else (show_vars, plots) is passed
+# through.  Cached arrays are shared between calls and read-only.
+def cached(reader, filename, **kwargs):
+    key = cache_key(reader, filename, kwargs)
+    data = cache_lookup(key)
+    if data is not None:
+        return data
+    data = cache_load(reader, filename, key, kwargs)
+    if not isinstance(data, dict):
+        return data
+    cache_remember(key, data)
+    return dict(data)
+
+
+# The disk layer of cached(): read the parsed result stored under key, or
+# parse the file and store it.  The in-memory layer and its lock are not
+# touched, so forked workers can use it while a thread of the parent
+# holds the lock.
+def cache_load(reader, filename, key, kwargs):
+    path = os.path.join(cache_dir, key + '.npz')
+    data = None
+    if cache_disk_bytes > 0:
+        data = cache_open(path)
+        if data is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+    if data is None:
+        data = reader(filename, **kwargs)
+        if not isinstance(data, dict):
+            return data
+        if cache_disk_bytes > 0:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                cache_write(path, data)
+                cache_evict_disk()
+            except (OSError, TypeError, ValueError):
+                # an unwritable cache directory or a result that does not
+                # fit the archive only costs the disk layer
+                pass
+    return data
+
+
+# Look a parsed result up in the in-memory layer, or return None
+def cache_lookup(key):
+    with cache_lock:
+        if key not in cache_memory:
+            return None
+        cache_memory.move_to_end(key)
+        return dict(cache_memory[key][0])
+
+
+# Put a parsed result in the in-memory layer, dropping the least recently
+# used entries beyond cache_memory_bytes.
+def cache_remember(key, data):
+    for val in data.values():
+        if isinstance(val, np.ndarray):
+            val.flags.writeable = False
+    size = cache_size(data)
+    with cache_lock:
+        if size <= cache_memory_bytes:
+            cache_memory[key] = (data, size)
+            total = sum(entry[1] for entry in cache_memory.values())
+            while total > cache_memory_bytes:
+                total -= cache_memory.popitem(last=False)[1][1]
+
+
+# Worker of load_many(): parse one file, through the disk layer of the
+# cache if key is given, and hand the arrays back as .npy files in tmpdir
+# instead of pickling them.
+def load_worker(reader, filename, kwargs, key, tmpdir, index):
+    if key is not None:
+        data = cache_load(reader, filename, key, kwargs)
+    else:
+        data = reader(filename, **kwargs)
+    if not isinstance(data, dict):
+        return data, []
+    arrays = []
+    for n, (key, val) in enumerate(data.items()):
+        if isinstance(val, np.ndarray):
+            path = os.path.join(tmpdir, '{0}.{1}.npy'.format(index, n))
+            np.save(path, val)
+            data[key] = path
+            arrays.append(key)
+    return data, arrays
+
+
+# Read many files with reader (tab, hst or bin) on a pool of worker
+# processes and return the results in the order of filenames.  Workers
+# write the decoded arrays to shared memory (/dev/shm where there is one)
+# and the results hold read-only memory maps of them, so frames are never
+# pickled between processes.  With cache set the files go through the
+# parsed-file cache, see cached(); workers only use its disk layer, so a
+# lock held by another thread at the fork does not block them.  workers
+# defaults to the number of cores.  Workers are forked, so without fork()
+# (Windows) or with a single worker the files are read one after another
+# in this process.
+def load_many(reader, filenames, workers=None, cache=False, **kwargs):
+    results = [None] * len(filenames)
+    todo = []
+    for i, name in enumerate(filenames):
+        key = cache_key(reader, name, kwargs) if cache else None
+        data = cache_lookup(key) if cache else None
+        if data is not None:
+            results[i] = data
+        else:
+            todo.append((i, key))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(todo))
+    if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for i, _ in todo:
+            if cache:
+                results[i] = cached(reader, filenames[i], **kwargs)
+            else:
+                results[i] = reader(filenames[i], **kwargs)
+        return results
+
+    tmpdir = tempfile.mkdtemp(prefix='athena_read.',
+                              dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            futures = [pool.submit(load_worker, reader, filenames[i], kwargs, key, tmpdir, i)
+                       for i, key in todo]
+            for (i, key), future in zip(todo, futures):
+                data, arrays = future.result()
+                for name in arrays:
+                    data[name] = np.load(data[name], mmap_mode='r')
+                if cache and isinstance(data, dict):
+                    cache_remember(key, data)
+                    data = dict(data)
+                results[i] = data
+    finally:
+        # the memory maps stay valid after their files are removed
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+# Frames of a run read on demand: frames[i] is reader(filenames[i], **kwargs)
+# (through the parsed-file cache with cache set).  Decoded frames are kept
+# up to max_bytes of arrays (default frame_cache_bytes), least recently
+# used ones are dropped first, and a background thread reads up to
+# prefetch frames ahead in the direction the frames were last stepped
+# through, so only the first frame is waited for.  Fewer frames are read
+# ahead when that many would not fit in max_bytes.
+class FrameCache:
+
+    def __init__(self, reader, filenames, max_bytes=None, prefetch=8, cache=False, **kwargs):
+        self.reader = reader
+        self.filenames = list(filenames)
+        self.max_bytes = frame_cache_bytes if max_bytes is None else max_bytes
+        self.prefetch = prefetch
+        self.cache = cache
+        self.kwargs = kwargs
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.frame_bytes = 0
+        self.loading = set()
+        self.ahead = []
+        self.last = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = None
+        if prefetch > 0:
+            self.thread = threading.Thread(target=self.run, name='FrameCache', daemon=True)
+            self.thread.start()
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __repr__(self):
+        return '<FrameCache {0} of {1} frames decoded>'.format(len(self.frames), len(self))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame {0} out of range'.format(index))
+        with self.condition:
+            self.schedule(index)
+            while index in self.loading:
+                self.condition.wait()
+            if index in self.frames:
+                self.frames.move_to_end(index)
+                return self.frames[index]
+            self.loading.add(index)
+        try:
+            data = self.load(index)
+        finally:
+            with self.condition:
+                self.loading.discard(index)
+                self.condition.notify_all()
+        with self.condition:
+            self.store(index, data)
+        return data
+
+    def load(self, index):
+        if self.cache:
+            return cached(self.reader, self.filenames[index], **self.kwargs)
+        return self.reader(self.filenames[index], **self.kwargs)
+
+    # keep a decoded frame, dropping the least recently used beyond
+    # max_bytes; the newest frame is kept even if it is larger on its own
+    def store(self, index, data):
+        if index in self.frames:
+            self.nbytes -= cache_size(self.frames[index])
+        self.frames[index] = data
+        self.frames.move_to_end(index)
+        self.frame_bytes = cache_size(data)
+        self.nbytes += self.frame_bytes
+        while self.nbytes > self.max_bytes and len(self.frames) > 1:
+            self.nbytes -= cache_size(self.frames.popitem(last=False)[1])
+        del self.ahead[self.fit():]
+
+    # number of frames that can be read ahead next to the current one
+    def fit(self):
+        if self.frame_bytes == 0:
+            return self.prefetch
+        return max(0, min(self.prefetch, self.max_bytes // self.frame_bytes - 1))
+
+    # queue the frames after index in the direction of the last step
+    def schedule(self, index):
+        step = -1 if self.last is not None and index < self.last else 1
+        self.last = index
+        self.ahead = [n for n in range(index + step, index + step * (self.fit() + 1), step)
+                      if 0 <= n < len(self)]
+        self.condition.notify_all()
+
+    # prefetch thread
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed and not any(n not in self.frames and n not in self.loading
+                                                  for n in self.ahead):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                index = next(n for n in self.ahead
+                             if n not in self.frames and n not in self.loading)
+                self.loading.add(index)
+            try:
+                data = self.load(index)
+            except Exception:
+                # the viewer reports the error when it asks for the frame
+                data = None
+            with self.condition:
+                self.loading.discard(index)
+                if data is not None:
+                    self.store(index, data)
+                self.ahead = [n for n in self.ahead if n != index]
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+# Minimum and maximum of every variable in every frame of a run, found on a
+# background thread that reads one frame at a time, so limits that hold
+# for the whole run are known without keeping the frames.  With
+# percentiles=(low, high) those percentiles of each frame (estimated from
+# at most 65536 evenly spaced values) are kept too.  The result is saved
+# in cache_dir under the names, sizes and modification times of the files,
+# so a run is only scanned once.
+class FrameLimits:
+
+    def __init__(self, reader, filenames, percentiles=None, **kwargs):
+        self.reader = reader
+        self.filenames = list(filenames)
+        self.percentiles = percentiles
+        self.kwargs = kwargs
+        self.data = None
+        self.done = threading.Event()
+        self.error = None
+        sources = [[os.path.abspath(name), os.path.getsize(name), os.stat(name).st_mtime_ns]
+                   for name in self.filenames]
+        args = sorted((key, repr(val)) for key, val in kwargs.items())
+        key = json.dumps(['limits', reader.__name__, sources, args, percentiles])
+        self.path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+        self.data = cache_open(self.path)
+        if self.data is not None:
+            self.done.set()
+        else:
+            self.thread = threading.Thread(target=self.run, name='FrameLimits', daemon=True)
+            self.thread.start()
+
+    def __repr__(self):
+        state = 'done' if self.done.is_set() else 'running'
+        return '<FrameLimits of {0} frames, {1}>'.format(len(self.filenames), state)
+
+    def run(self):
+        try:
+            data = {}
+            nframes = len(self.filenames)
+            for i, name in enumerate(self.filenames):
+                frame = self.reader(name, **self.kwargs)
+                for var, val in frame.items():
+                    if not isinstance(val, np.ndarray) or val.size == 0:
+                        continue
+                    if 'min.' + var not in data:
+                        data['min.' + var] = np.full(nframes, np.nan)
+                        data['max.' + var] = np.full(nframes, np.nan)
+                        if self.percentiles is not None:
+                            data['low.' + var] = np.full(nframes, np.nan)
+                            data['high.' + var] = np.full(nframes, np.nan)
+                    with warnings.catch_warnings():
+                        # all-NaN frames keep NaN limits
+                        warnings.simplefilter('ignore', RuntimeWarning)
+                        data['min.' + var][i] = np.nanmin(val)
+                        data['max.' + var][i] = np.nanmax(val)
+                        if self.percentiles is not None:
+                            flat = val.ravel()
+                            sample = flat[::max(1, flat.size // 65536)]
+                            low, high = np.nanpercentile(sample, self.percentiles)
+                            data['low.' + var][i] = low
+                            data['high.' + var][i] = high
+            self.data = data
+            if cache_disk_bytes > 0:
+                try:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    cache_write(self.path, data)
+                    cache_evict_disk()
+                except OSError:
+                    pass
+        except Exception as error:
+            # keep the viewer running on its per-frame limits
+            self.error = error
+        finally:
+            self.done.set()
+
+    # Wait for the scan; returns True once it has finished
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    # (low, high) of a variable over all frames, or of one frame, using the
+    # percentiles if they were asked for.  None until the scan has finished
+    # or if the variable was not found.
+    def limits(self, variable, frame=None):
+        if not self.done.is_set() or self.data is None or 'min.' + variable not in self.data:
+            return None
+        if self.percentiles is not None:
+            low, high = self.data['low.' + variable], self.data['high.' + variable]
+        else:
+            low, high = self.data['min.' + variable], self.data['max.' + variable]
+        if frame is not None:
+            return float(low[frame]), float(high[frame])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return float(np.nanmin(low)), float(np.nanmax(high))
+
+
 # General exception class for these functions
 class AthenaError(RuntimeError):
     pass
@@ -461,6 +1700,6 @@ if __name__ == "__main__":
         print('data',d)
     else:
         print(tab(sys.argv[1],True))
-        d = tab(sys.argv[1],False)
+        d = cached(tab, sys.argv[1])
         print('data',d)
         
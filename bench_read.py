@@ -0,0 +1,405 @@
+#! /usr/bin/env python
+#
+#     bench_read:   time the athena_read readers against the reference
+#                   implementations they replaced, on synthetic data
+#
+#     python bench_read.py tab --cells 65536 --frames 20
+#
+import numpy as np
+import athena_read
+import os
+import re
+import struct
+import tempfile
+import time
+import warnings
+from argparse import ArgumentParser
+
+
+# The original line-by-line .tab reader, kept as the reference
+def tab_loop(filename):
+    data_dict = {}
+    with open(filename, 'r') as data_file:
+        line = data_file.readline()
+        attributes = re.search(r'time=(\S+)\s+cycle=(\S+)', line)
+        line = data_file.readline()
+        headings = line.split()[1:]
+    headings = headings[1:]
+
+    data_array = []
+    num_lines = 0
+    with open(filename, 'r') as data_file:
+        first_line = True
+        for line in data_file:
+            if line.split()[0][0] == '#':
+                continue
+            vals = line.split()
+            if first_line:
+                num_entries = len(vals) - 1
+                first_line = False
+            vals = vals[1:]
+            data_array.append([float(val) for val in vals])
+            num_lines += 1
+
+    array_shape = (num_lines, num_entries)
+    array_transpose = (1, 0)
+    data_array = np.transpose(np.reshape(data_array, array_shape),
+                              array_transpose)
+    for n, heading in enumerate(headings):
+        data_dict[heading] = data_array[n, ...]
+    data_dict['time'] = float(attributes.group(1))
+    data_dict['cycle'] = int(attributes.group(2))
+    return data_dict
+
+
+# The original branch pruning of athena_read.hst, kept as the reference
+def prune_loop(data):
+    branches_removed = False
+    while not branches_removed:
+        branches_removed = True
+        for n in range(1, len(data['time'])):
+            if data['time'][n] <= data['time'][n-1]:
+                branch_index = np.where((data['time'][:n] >=
+                                         data['time'][n]))[0][0]
+                for key, val in data.items():
+                    data[key] = np.concatenate((val[:branch_index],
+                                                val[n:]))
+                branches_removed = False
+                break
+    return data
+
+
+# The original line-by-line .hst reader, kept as the reference
+def hst_loop(filename):
+    with open(filename, 'r') as data_file:
+        header_location = None
+        line = data_file.readline()
+        while len(line) > 0:
+            if re.match(r'# Athena\S* history data\n', line):
+                header_location = data_file.tell()
+            line = data_file.readline()
+        data_file.seek(header_location)
+        header = data_file.readline()
+        data_names = re.findall(r'\[\d+\]=(\S+)', header)
+        data = {}
+        for name in data_names:
+            data[name] = []
+        for line in data_file:
+            for name, val in zip(data_names, line.split()):
+                data[name].append(float(val))
+    for key, val in data.items():
+        data[key] = np.array(val)
+    return prune_loop(data)
+
+
+# Synthetic history of nrows rows of a run that was restarted nrestarts
+# times, each time from a random earlier point
+def make_history(nrows, nrestarts, seed=1):
+    rng = np.random.default_rng(seed)
+    segments = []
+    t = 0.0
+    for length in np.diff(np.sort(rng.integers(0, nrows, nrestarts)), prepend=0, append=nrows):
+        if segments:
+            t = rng.uniform(0, t)
+        segment = t + 0.01 * np.arange(1, length + 1)
+        segments.append(segment)
+        if length > 0:
+            t = segment[-1]
+    time = np.concatenate(segments)
+    return {'time': time, 'dt': np.full(nrows, 0.01), 'mass': np.cos(time)}
+
+
+# Write an athenak style .hst file; restarts are appended to the same
+# block, optionally with a new header in front of each of them
+def write_hst(filename, data, headers=False):
+    names = list(data)
+    header = '# AthenaK history data\n# ' + \
+        '  '.join('[%d]=%s' % (n + 1, name) for n, name in enumerate(names)) + '\n'
+    table = np.array([data[name] for name in names]).T
+    restarts = np.flatnonzero(np.diff(data['time']) <= 0) + 1 if headers else []
+    with open(filename, 'w') as f:
+        for rows in np.split(table, restarts):
+            f.write(header)
+            np.savetxt(f, rows, fmt='%.14e')
+
+
+# Write an athenak style .tab file with ncells rows
+def write_tab(filename, ncells, time=0.0, cycle=0,
+              variables=('dens', 'velx', 'vely', 'velz', 'eint')):
+    x = np.linspace(-0.5, 0.5, ncells)
+    cols = [np.zeros(ncells), np.arange(ncells), x]
+    for n in range(len(variables)):
+        cols.append(np.sin(2 * np.pi * (x + 0.1 * n + time)))
+    with open(filename, 'w') as f:
+        f.write('# AthenaK data at time=%e  cycle=%d  variables=%s\n'
+                % (time, cycle, ' '.join(variables)))
+        f.write('# gid  i       x1v       %s\n' % '       '.join(variables))
+        np.savetxt(f, np.array(cols).T, fmt=['%d', '%d'] + ['%e'] * (len(cols) - 2))
+
+
+# The original way of decoding a z slice of one variable from a .bin
+# file, one struct.unpack per meshblock, kept as the reference
+def bin_struct(filename, variable, location=0.0):
+    header = athena_read.bin_header(filename)
+    nvars = len(header['variable_names'])
+    ind = header['variable_names'].index(variable)
+    nz, ny, nx = header['block_shape']
+    cells = nz * ny * nx
+    fmt = '=' + str(cells) + header['variable_dtype'].char
+    size = cells * header['variable_dtype'].itemsize
+    loc_size = header['location_dtype'].itemsize
+    mesh = header['input_data']['mesh']
+    x3min, x3max = float(mesh['x3min']), float(mesh['x3max'])
+    nblocks3 = int(mesh['nx3']) // nz
+    mesh_ind = min(int((location - x3min) / (x3max - x3min) * nz * nblocks3), nz * nblocks3 - 1)
+    slices = []
+    with open(filename, 'rb') as f:
+        f.seek(header['data_offset'])
+        while f.tell() < header['file_size']:
+            f.read(24)
+            block_i, block_j, block_k, block_level = struct.unpack('@4i', f.read(16))
+            if block_k != mesh_ind // nz:
+                f.seek(6 * loc_size + nvars * size, 1)
+                continue
+            f.seek(6 * loc_size + ind * size, 1)
+            cell_data = np.array(struct.unpack(fmt, f.read(size))).reshape(nz, ny, nx)
+            slices.append(cell_data[mesh_ind % nz])
+            f.seek((nvars - ind - 1) * size, 1)
+    return np.array(slices)
+
+
+# Write an athenak style .bin file of an nx1 x nx2 x nx3 mesh cut in
+# meshblocks of mb1 x mb2 x mb3 cells; dtype is 'f' or 'd'.  With refine,
+# the first meshblock of a 2D mesh is replaced by four level 1 blocks.
+def write_bin(filename, nx1, nx2, nx3=1, mb1=None, mb2=None, mb3=None, time=0.0,
+              cycle=0, dtype='f', variables=('dens', 'velx', 'vely', 'velz', 'eint'),
+              refine=False):
+    mb1 = mb1 or nx1
+    mb2 = mb2 or nx2
+    mb3 = mb3 or nx3
+    nghost = 2
+    size = np.dtype(dtype).itemsize
+    athinput = ('<comment>\nproblem = synthetic\n'
+                '<mesh>\nnghost = %d\nnx1 = %d\nx1min = -0.5\nx1max = 0.5\n'
+                'nx2 = %d\nx2min = -0.5\nx2max = 0.5\n'
+                'nx3 = %d\nx3min = -0.5\nx3max = 0.5\n'
+                '<meshblock>\nnx1 = %d\nnx2 = %d\nnx3 = %d\n'
+                % (nghost, nx1, nx2, nx3, mb1, mb2, mb3))
+    header = ('Athena binary output version=1.1\n'
+              '  size of preheader=5\n'
+              '  time=%.14e\n  cycle=%d\n'
+              '  size of location=%d\n  size of variable=%d\n'
+              '  number of variables=%d\n  variables:  %s  \n'
+              '  header offset=%d\n'
+              % (time, cycle, size, size, len(variables), '  '.join(variables),
+                 len(athinput)))
+    # cell centers of the whole mesh, and a field per variable
+    x1 = -0.5 + (np.arange(nx1) + 0.5) / nx1
+    x2 = -0.5 + (np.arange(nx2) + 0.5) / nx2
+    x3 = -0.5 + (np.arange(nx3) + 0.5) / nx3
+    z, y, x = np.meshgrid(x3, x2, x1, indexing='ij')
+    fields = [np.sin(2 * np.pi * (x + time)) * np.cos(2 * np.pi * y) + z + n
+              for n in range(len(variables))]
+    gs = nghost if nx2 > 1 else 0
+    with open(filename, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(athinput.encode('ascii'))
+        for k in range(nx3 // mb3):
+            for j in range(nx2 // mb2):
+                for i in range(nx1 // mb1):
+                    ks = nghost if nx3 > 1 else 0
+                    if refine and i == j == k == 0:
+                        write_bin_refined(f, nx1, nx2, mb1, mb2, nghost, time,
+                                          dtype, len(variables))
+                        continue
+                    f.write(np.array([nghost, nghost + mb1 - 1, gs, gs + mb2 - 1,
+                                      ks, ks + mb3 - 1, i, j, k, 0], dtype=np.intc).tobytes())
+                    f.write(np.array([-0.5 + i * mb1 / nx1, -0.5 + (i + 1) * mb1 / nx1,
+                                      -0.5 + j * mb2 / nx2, -0.5 + (j + 1) * mb2 / nx2,
+                                      -0.5 + k * mb3 / nx3, -0.5 + (k + 1) * mb3 / nx3],
+                                     dtype=dtype).tobytes())
+                    for field in fields:
+                        f.write(field[k * mb3:(k + 1) * mb3, j * mb2:(j + 1) * mb2,
+                                      i * mb1:(i + 1) * mb1].astype(dtype).tobytes())
+
+
+# The four level 1 meshblocks covering the first root meshblock of a 2D
+# mesh, with the fields of write_bin() at twice the resolution
+def write_bin_refined(f, nx1, nx2, mb1, mb2, nghost, time, dtype, nvars):
+    x1 = -0.5 + (np.arange(2 * nx1) + 0.5) / (2 * nx1)
+    x2 = -0.5 + (np.arange(2 * nx2) + 0.5) / (2 * nx2)
+    y, x = np.meshgrid(x2, x1, indexing='ij')
+    fields = [np.sin(2 * np.pi * (x + time)) * np.cos(2 * np.pi * y) + n
+              for n in range(nvars)]
+    for j in range(2):
+        for i in range(2):
+            f.write(np.array([nghost, nghost + mb1 - 1, nghost, nghost + mb2 - 1,
+                              0, 0, i, j, 0, 1], dtype=np.intc).tobytes())
+            f.write(np.array([-0.5 + i * mb1 / (2 * nx1), -0.5 + (i + 1) * mb1 / (2 * nx1),
+                              -0.5 + j * mb2 / (2 * nx2), -0.5 + (j + 1) * mb2 / (2 * nx2),
+                              -0.5, 0.5], dtype=dtype).tobytes())
+            for field in fields:
+                f.write(field[j * mb2:(j + 1) * mb2,
+                              i * mb1:(i + 1) * mb1].astype(dtype).tobytes())
+
+
+# Compare two dicts of arrays and scalars
+def same(d1, d2):
+    if d1.keys() != d2.keys():
+        return False
+    for key in d1:
+        if not np.array_equal(d1[key], d2[key]):
+            return False
+    return True
+
+
+# Best wall clock time of calling fn on every file
+def best_of(fn, files, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for f in files:
+            fn(f)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def bench_tab(args, tmpdir):
+    files = []
+    for i in range(args.frames):
+        name = os.path.join(tmpdir, 'bench.%05d.tab' % i)
+        write_tab(name, args.cells, time=0.01 * i, cycle=10 * i)
+        files.append(name)
+    if not same(tab_loop(files[0]), athena_read.tab(files[0])):
+        raise RuntimeError('athena_read.tab differs from the reference reader')
+    t_old = best_of(tab_loop, files, args.repeat)
+    t_new = best_of(athena_read.tab, files, args.repeat)
+    t_two = best_of(lambda f: athena_read.tab(f, columns=['x1v', 'dens']), files, args.repeat)
+    # repeat opens through the parsed-file cache, from disk and from memory
+    athena_read.cache_dir = os.path.join(tmpdir, 'cache')
+    athena_read.cache_clear()
+    if not same(athena_read.tab(files[0]), athena_read.cached(athena_read.tab, files[0])):
+        raise RuntimeError('athena_read.cached differs from athena_read.tab')
+    memory_bytes = athena_read.cache_memory_bytes
+    athena_read.cache_memory_bytes = 0
+    t_disk = best_of(lambda f: athena_read.cached(athena_read.tab, f), files, args.repeat)
+    athena_read.cache_memory_bytes = memory_bytes
+    t_memory = best_of(lambda f: athena_read.cached(athena_read.tab, f), files, args.repeat)
+    print('tab: %d files x %d cells' % (args.frames, args.cells))
+    print('  reference loop  %8.3f sec' % t_old)
+    print('  athena_read.tab %8.3f sec   speedup %.1fx' % (t_new, t_old / t_new))
+    print('    two columns   %8.3f sec   speedup %.1fx' % (t_two, t_old / t_two))
+    print('    disk cache    %8.3f sec   speedup %.1fx' % (t_disk, t_old / t_disk))
+    print('    memory cache  %8.3f sec   speedup %.1fx' % (t_memory, t_old / t_memory))
+
+
+def bench_hst(args, tmpdir):
+    for nrows, nrestarts in ((10, 3), (1000, 0), (1000, 1), (1000, 50), (5000, 500)):
+        for seed in range(5):
+            data = make_history(nrows, nrestarts, seed)
+            pruned = prune_loop(dict(data))
+            keep = athena_read.hst_keep(data['time'])
+            if not same(pruned, {key: val[keep] for key, val in data.items()}):
+                raise RuntimeError('athena_read.hst_keep differs from the reference pruning')
+    name = os.path.join(tmpdir, 'bench.hst')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for headers in (False, True):
+            write_hst(name, make_history(2000, 20), headers)
+            reference = hst_loop(name)
+            if not same(reference, athena_read.hst(name)):
+                raise RuntimeError('athena_read.hst differs from the reference reader')
+            if not same(reference, athena_read.hst(name, mmap=True)):
+                raise RuntimeError('athena_read.hst with mmap differs from the reference reader')
+            if not same(reference, athena_read.hst(name, columns=['time', 'dt', 'mass'])):
+                raise RuntimeError('athena_read.hst column projection differs')
+
+        write_hst(name, make_history(args.rows, args.restarts))
+        t_old = best_of(hst_loop, [name], args.repeat)
+        t_new = best_of(athena_read.hst, [name], args.repeat)
+        t_map = best_of(lambda f: athena_read.hst(f, mmap=True), [name], args.repeat)
+    print('hst: reading %d rows with %d restarts' % (args.rows, args.restarts))
+    print('  reference reader     %8.3f sec' % t_old)
+    print('  athena_read.hst      %8.3f sec   speedup %.1fx' % (t_new, t_old / t_new))
+    print('    memory mapped      %8.3f sec   speedup %.1fx' % (t_map, t_old / t_map))
+
+    # follow a file that grows in uneven pieces, cutting rows in half
+    live = os.path.join(tmpdir, 'live.hst')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for headers in (False, True):
+            write_hst(name, make_history(2000, 20), headers)
+            with open(name, 'rb') as f:
+                full = f.read()
+            open(live, 'wb').close()
+            tail = athena_read.HistoryTail(live)
+            rng = np.random.default_rng(2)
+            pos = 0
+            while pos < len(full):
+                step = int(rng.integers(1, 4000))
+                with open(live, 'ab') as f:
+                    f.write(full[pos:pos + step])
+                pos += step
+                data = tail.poll()
+                # compare once the column names of the last block are in
+                if full.rfind(b'\n', 0, pos) > full.rfind(b'[1]=time', 0, pos) >= 0:
+                    if not same(data, athena_read.hst(live)):
+                        raise RuntimeError('athena_read.HistoryTail differs from athena_read.hst')
+
+    data = make_history(args.rows, args.restarts)
+    t_old = best_of(lambda d: prune_loop(dict(d)), [data], args.repeat)
+    t_new = best_of(lambda d: athena_read.hst_keep(d['time']), [data], args.repeat)
+    print('hst: pruning %d rows with %d restarts' % (args.rows, args.restarts))
+    print('  reference loop       %8.3f sec' % t_old)
+    print('  athena_read.hst_keep %8.4f sec   speedup %.0fx' % (t_new, t_old / t_new))
+
+
+def bench_bin(args, tmpdir):
+    kwargs = {'variable': 'dens', 'dimension': 'z', 'location': 0.0, 'output_file': None}
+    # a whole number of cells per meshblock in the 4x4 layout below
+    n = 4 * max(1, int(round(args.cells ** 0.5 / 4)))
+    single = os.path.join(tmpdir, 'single.bin')
+    write_bin(single, n, n)
+    if not np.array_equal(bin_struct(single, 'dens')[0], athena_read.bin(single, **kwargs)['dens']):
+        raise RuntimeError('athena_read.bin differs from the reference decoding')
+    files = []
+    for i in range(args.frames):
+        name = os.path.join(tmpdir, 'bench.%05d.bin' % i)
+        write_bin(name, n, n, mb1=n // 4, mb2=n // 4, time=0.01 * i)
+        files.append(name)
+    if not np.array_equal(athena_read.bin(single, **kwargs)['dens'],
+                          athena_read.bin(files[0], **kwargs)['dens']):
+        raise RuntimeError('athena_read.bin assembles meshblocks wrongly')
+    # a 2D slice through refined meshblocks is resampled to the finest level
+    refined = os.path.join(tmpdir, 'refined.bin')
+    write_bin(refined, 8, 8, mb1=4, mb2=4, refine=True)
+    uniform = athena_read.bin_uniform(athena_read.bin_levels(refined), 'dens')[0]
+    if not np.array_equal(uniform, athena_read.bin(refined, **kwargs)['dens']):
+        raise RuntimeError('athena_read.bin drops refined meshblocks of a 2D mesh')
+    t_old = best_of(lambda f: bin_struct(f, 'dens'), files, args.repeat)
+    t_new = best_of(lambda f: athena_read.bin(f, **kwargs), files, args.repeat)
+    print('bin: %d files x %d x %d cells in 16 meshblocks' % (args.frames, n, n))
+    print('  struct.unpack   %8.3f sec' % t_old)
+    print('  athena_read.bin %8.3f sec   speedup %.1fx' % (t_new, t_old / t_new))
+
+
+benchmarks = {
+    'tab': bench_tab,
+    'hst': bench_hst,
+    'bin': bench_bin,
+}
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(description='benchmark the athena_read readers on synthetic data')
+    argparser.add_argument('what', nargs='*', default=list(benchmarks),
+                           help='which benchmarks to run: %s' % ', '.join(benchmarks))
+    argparser.add_argument('--cells', type=int, default=65536, help='number of cells per snapshot')
+    argparser.add_argument('--frames', type=int, default=20, help='number of snapshots')
+    argparser.add_argument('--rows', type=int, default=100000, help='number of history rows')
+    argparser.add_argument('--restarts', type=int, default=200, help='number of restarts in the history')
+    argparser.add_argument('--repeat', type=int, default=3, help='take the best of this many runs')
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for what in args.what:
+            benchmarks[what](args, tmpdir)
@@ -3,8 +3,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import RadioButtons, Button, Slider, CheckButtons, TextBox
 from argparse import ArgumentParser
+import athena_read
 import glob
-import os
 import matplotlib.style as mplstyle
 mplstyle.use(['ggplot', 'fast'])
 
@@ -16,32 +16,105 @@ mplstyle.use(['ggplot', 'fast'])
 # IMPORTING FROM ANIMATE2
 # function that draws each frame of the animation
 def animate(i):
-    global xcol, ycol, current_frame, xlim, ylim
+    global xcol, ycol, current_frame, xlim, ylim, shown, updating
     # print(f[i])
-    d = np.loadtxt(f[i]).T
-    x = d[ixcol]
-    y = d[iycol]
-    if not args.hst:
-        with open(f[i]) as file:
-            # first line is target
-            # terribly lazy but it works, maybe just use regex
-            time = file.readline().split('=')[1].split(' ')[0]
-    ax.clear()
+    # tab frames come from the store or the frame cache of the plotted columns
+    if store is not None:
+        x = store[xcol][i]
+        y = store[ycol][i]
+        time = store['time'][i]
+    elif args.hst:
+        # the history file may still be growing, only read what was added
+        if f[i] not in hst_tails:
+            hst_tails[f[i]] = athena_read.HistoryTail(f[i])
+        d = hst_tails[f[i]].poll()
+    else:
+        d = frames[i]
+        time = d['time']
+    if store is None:
+        x = d[xcol]
+        y = d[ycol]
+    # the line and title are made once and updated in place
+    updating = True
+    old_limits = (ax.get_xlim(), ax.get_ylim())
+    shown = (x, y)
+    line.set_linestyle('None' if use_dot else '-')
+    line.set_marker('.' if use_dot else 'None')
+    if args.fix:
+        # the range of both columns over all frames, once it is known
+        lim = run_limits(xcol), run_limits(ycol)
+        if None not in lim:
+            xlim = athena_read.padded_limits(lim[0], ax.margins()[0])
+            ylim = athena_read.padded_limits(lim[1], ax.margins()[1])
     if xlim:
         ax.set_xlim(xlim)
         ax.set_ylim(ylim)
-    ax.plot(x, y, '.' if use_dot else '-')
+    show_line()
+    if not xlim:
+        ax.relim()
+        ax.autoscale_view()
+    updating = False
     if not xlim and args.fix: # just need to check one since its either both or none
         xlim = ax.get_xlim()
         ylim = ax.get_ylim()
     if not args.hst:
-        ax.set_title(f'Time: {float(time)}', loc='left')
+        title.set_text(f'Time: {float(time)}')
     else:
-        ax.set_title(f'History', loc='left')
-    ax.set_xlabel(xcol)
-    ax.set_ylabel(ycol)
+        title.set_text(f'History')
+    redraw = old_limits != (ax.get_xlim(), ax.get_ylim())
+    if ax.get_xlabel() != xcol or ax.get_ylabel() != ycol:
+        ax.set_xlabel(xcol)
+        ax.set_ylabel(ycol)
+        redraw = True
+    draw_frame(redraw)
 # END IMPORT
 
+# draw the shown line decimated to the lowest and highest point per pixel
+# column of the visible x range (all of it while autoscaling)
+def show_line():
+    x, y = shown
+    view = None if ax.get_autoscalex_on() else ax.get_xlim()
+    width = max(int(ax.get_window_extent().width), 1)
+    line.set_data(*athena_read.decimate_line(x, y, width, view))
+
+# zooming and panning decimate the line again, the toolbar redraws
+def on_zoom(axes):
+    if shown is not None and not updating:
+        show_line()
+
+# range of a column over all frames, None while it is still being found
+def run_limits(col):
+    if store is not None:
+        if col not in store_limits:
+            store_limits[col] = (np.nanmin(store[col]), np.nanmax(store[col]))
+        return store_limits[col]
+    return limits.limits(col) if limits is not None else None
+
+# show the current line and title, blitting them over the saved background
+# unless the axes changed and the whole figure has to be drawn again
+def draw_frame(redraw):
+    if redraw or background is None or not fig.canvas.supports_blit:
+        fig.canvas.draw_idle()
+        return
+    fig.canvas.restore_region(background)
+    draw_animated(fig.canvas.get_renderer())
+    fig.canvas.blit(fig.bbox)
+
+# draw the artists that full draws leave out
+def draw_animated(renderer):
+    line.draw(renderer)
+    title.draw(renderer)
+    if fax is not None:
+        fax.draw(renderer)
+
+# save the figure without the animated artists after every full draw of
+# the window; saving to a file draws them into the file as well
+def on_draw(event):
+    global background
+    if event.canvas is canvas and canvas.supports_blit and not canvas.is_saving():
+        background = canvas.copy_from_bbox(fig.bbox)
+    draw_animated(event.renderer)
+
 # hard-pauses the animation
 # that is, the only way to unpause is by using the play or restart button
 def hpause(self=None):
@@ -63,10 +136,12 @@ def play(self=None):
 def pause(self=None):
     global is_playing, fig
     if is_playing:
-        fig.canvas.stop_event_loop()
+        timer.stop()
         is_playing = False
 
 # plays the animation (either starts or resumes)
+# frames are advanced by a timer of the canvas rather than a blocking loop,
+# so several viewers can play at once in one process (see viewer.py)
 def resume(self=None):
     global is_playing, current_frame, ax, length, frame_sliding, hard_paused
     if not is_playing:
@@ -74,15 +149,26 @@ def resume(self=None):
         is_playing = True
         hard_paused = False
         #bpause.color = '0.85'
-        while current_frame < length and is_playing:
-            animate(current_frame)
-            current_frame += 1
-            fig.canvas.draw_idle()
-            fig.canvas.start_event_loop(delay)
-            frame_sliding = False
-            fslider.set_val(current_frame)
+        timer.interval = max(int(delay * 1000), 1)
+        timer.start()
+
+# shows the next frame, called by the playback timer
+def step():
+    global is_playing, current_frame, frame_sliding
+    if not is_playing:
+        return
+    if current_frame < length:
+        current_frame += 1
+        frame_sliding = False
+        # move the slider without calling update_fslider, it is drawn with the frame
+        fslider.eventson = False
+        fslider.set_val(current_frame)
+        fslider.eventson = True
+        animate(current_frame - 1)
+    if current_frame >= length:
+        timer.stop()
         is_playing = False
-        if loop and current_frame == length:
+        if loop:
             restart()
 
 # loops the animation
@@ -111,7 +197,6 @@ def select_h(label):
     else:
         xlim = None
         animate(current_frame)
-        fig.canvas.draw_idle()
 
 # select the verticle variable
 def select_v(label):
@@ -122,7 +207,6 @@ def select_v(label):
     else:
         xlim = None
         animate(current_frame)
-        fig.canvas.draw_idle()
 
 def update_cols(x, y):
     global xcol, ycol, ixcol, iycol
@@ -130,16 +214,29 @@ def update_cols(x, y):
     ycol=y
     ixcol = variables.index(x)
     iycol = variables.index(y)
+    open_frames()
+
+# decoded tab frames of the plotted columns, read ahead during playback
+def open_frames():
+    global frames
+    if args.hst or store is not None:
+        return
+    columns = list(dict.fromkeys([xcol, ycol]))
+    if frames is not None:
+        if frames.kwargs['columns'] == columns:
+            return
+        frames.close()
+    frames = athena_read.FrameCache(athena_read.tab, f, columns=columns, cache=True)
 
 def update_delay(x):
     global delay
     delay = x / 1000
+    timer.interval = max(int(x), 1)
 
 def update_fslider(n):
     global frame_sliding, current_frame
     current_frame = n
     animate(current_frame - 1)
-    fig.canvas.draw_idle()
 
 '''def fix_axes(v):
     global xlim, ylim
@@ -158,25 +255,25 @@ def dotboxf(self):
     global use_dot
     use_dot = not use_dot
     animate(current_frame)
-    fig.canvas.draw_idle()
 
 argparser = ArgumentParser(description='plots the athena tab files specified')
 argparser.add_argument('-d', '--dir', help='the athena run directory containing tab/ or *.tab files', required=True)
 argparser.add_argument('--hst', action='store_true', help='plots the hst file rather animating the tab files')
 argparser.add_argument('-n', '--name', help='name of the problem being plotted') # primarily just used by the other gui
-argparser.add_argument('-f', '--fix', action='store_true', help='fixes the x and y axes of the animation based on the animation\'s first frame')
+argparser.add_argument('-f', '--fix', action='store_true', help='fixes the x and y axes to the range of the columns over all frames (from the first frame until that is known)')
 args = argparser.parse_args()
 
 # fnames='run1/tab/LinWave*tab'
+store = None
 if args.hst:
     f = glob.glob(args.dir + '/*.hst')
 else:
-    if os.path.exists(args.dir + '/tab'):
-        # athena++/athenak style
-        f = glob.glob(args.dir + '/tab/*.tab')
-    else:
-        # athenac style
-        f = glob.glob(args.dir + '/*.tab')
+    # athena++/athenak style in tab/, athenac style in the run directory
+    f = athena_read.run_files(args.dir, 'tab')
+    # a columnar store made by store_run.py saves parsing every frame
+    store = athena_read.open_store(args.dir, 'tab')
+    if store is not None:
+        print("Using the tab store of %s" % args.dir)
 f.sort()
 length = len(f)
 #print('DEBUG: %s has %d files' % (fnames,len(f)))
@@ -190,6 +287,13 @@ frame_sliding = False
 xlim = None
 ylim = None
 use_dot = False
+hst_tails = {}
+frames = None
+# column ranges over the whole run for --fix, found in the background
+limits = None
+store_limits = {}
+if args.fix and not args.hst and store is None:
+    limits = athena_read.FrameLimits(athena_read.tab, f)
 
 # plot settings
 left = 0.34
@@ -205,21 +309,22 @@ if args.hst:
 delay = 100 / 1000
 
 # getting the variable names
-with open(f[0]) as file:
-    file.readline()
+if args.hst:
+    with open(f[0]) as file:
+        file.readline()
+        # history files have as 2nd line
+        # [1]=time      [2]=dt       [3]=mass ...
+        # @todo  AthenaC has spaces in the column names, would need a different parsers
+        line2 = file.readline()
+        print("DEBUG hst",line2)
+        variables = [v.split('=')[1] for v in line2.split()[1:]]
+else:
     # regular tab file have as 2nd line
     # i       x1v         rho ...               for athena
     # gid   i       x1v         dens ...        for athenak
-    line2 = file.readline()
-    variables = line2.split()[1:]
-
-    # history files have as 2nd line
-    # [1]=time      [2]=dt       [3]=mass ...
-    # @todo  AthenaC has spaces in the column names, would need a different parsers
-    if args.hst:
-        print("DEBUG hst",line2)
-        variables = [v.split('=')[1] for v in variables]
-    print("tab variables detected:",variables)
+    # the first (index) column is not returned by athena_read.tab
+    variables = store['variables'] if store is not None else athena_read.tab(f[0], show_vars=True)
+print("tab variables detected:",variables)
 
 var_len = len(variables)
 
@@ -228,13 +333,28 @@ xcol=variables[0]
 ycol=variables[0]
 ixcol = 0
 iycol = 0
+open_frames()
 
 # plotting configuration
 fig, ax = plt.subplots()
+# the window canvas, savefig() swaps fig.canvas for that of the file format
+canvas = fig.canvas
 fig.subplots_adjust(left=left, bottom=bottom, top=top) # old bottom was 0.34
 # plt.rcParams['font.family'] = 'Arial'
 # pause on close otherwise we might freeze
 fig.canvas.mpl_connect('close_event', pause)
+# drives the playback, see resume()
+timer = fig.canvas.new_timer(interval=int(delay * 1000))
+timer.add_callback(step)
+# artists updated by animate(), drawn by blitting
+line, = ax.plot([], [], '-', animated=True)
+title = ax.set_title('', loc='left')
+title.set_animated(True)
+ax.callbacks.connect('xlim_changed', on_zoom)
+shown = None
+updating = False
+background = None
+fax = None
 # fig.set_size_inches(10, 10)
 
 plt.get_current_fig_manager().set_window_title(args.name if args.name else f[0].split('.')[0])
@@ -301,6 +421,8 @@ if not args.hst:
     delay_slider.on_changed(update_delay)
 
     fax = fig.add_axes([0.18, 0.95, 0.65, 0.03])
+    # animated, so the old frame number is not left in the saved background
+    fax.set_animated(True)
     fslider = Slider(
         ax=fax,
         label='Frame',
@@ -311,6 +433,8 @@ if not args.hst:
     )
 
     fslider.on_changed(update_fslider)
+    # the slider is drawn with each frame instead of redrawing the figure
+    fslider.drawon = False
 
     '''cbax = fig.add_axes([bstart + 3 * bwidth + 3 * bspace, 0.09, 0.1, 0.125])
     fix_cbox = CheckButtons(
@@ -372,4 +496,9 @@ else:
     dotbox.on_clicked(dotboxf)
     dotax.set_facecolor('white')
 
-plt.show()
+# connected last, so the background is saved after the widgets drew themselves
+fig.canvas.mpl_connect('draw_event', on_draw)
+
+# viewer.py shows the windows of several viewers at once
+if __name__ == "__main__":
+    plt.show()
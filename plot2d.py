@@ -7,8 +7,6 @@ import matplotlib.pyplot as plt
 from matplotlib.widgets import RadioButtons, Button, Slider, CheckButtons, TextBox
 from argparse import ArgumentParser
 import athena_read
-import glob
-import os
 import sys
 import matplotlib.style as mplstyle
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -20,7 +18,8 @@ from mpl_toolkits.axes_grid1 import make_axes_locatable
 # nonlinear (logarithmic?) slider
 
 kwargs = {}
-kwargs['variable'] = 'dens'
+# all variables are read in one pass, switching variables is a lookup
+kwargs['variable'] = 'all'
 kwargs['dimension'] = 'z'
 kwargs['location'] = 0
 kwargs['vmin'] = None
@@ -34,49 +33,142 @@ kwargs['x1_max'] = None
 kwargs['x2_min'] = None
 kwargs['x2_max'] = None
 kwargs['output_file'] = None
+# keep single precision data in single precision, halves the frame cache
+kwargs['dtype'] = 'native'
 
 zvar = 'dens'
 
 # https://saturncloud.io/blog/how-to-animate-the-colorbar-in-matplotlib-a-guide/
 
 def animate(i):
-    global xcol, ycol, current_frame, xlim, ylim, kwargs
-    kwargs['variable'] = zvar
-    if False:
-        d = athena_read.bin(f[i],False,**kwargs)
+    global xcol, ycol, current_frame, xlim, ylim, kwargs, shown, full_extent
+    if store is not None:
+        frame = {zvar: store[zvar][i]}
+        time = store['time'][i]
+        xlim = store['xlim']
+        ylim = store['ylim']
     else:
-        d = data[i][zvar][0]
-    time = data[i]['time']
-    xlim = data[i]['xlim']
-    ylim = data[i]['ylim']
+        frame = data[i]
+        time = data[i]['time']
+        xlim = data[i]['xlim']
+        ylim = data[i]['ylim']
     extent=[xlim[0],xlim[1],ylim[0],ylim[1]]
     #sax.set_xlim((-0.5,0.5))
-    
 
-    ax.clear()
-    #ax.set_xlim(xlim)
-    #ax.set_ylim(ylim)
-    if True:
-        im = ax.imshow(d,cmap=kwargs['cmap'],  # norm=norm, vmin=vmin, vmax=vmax,
-                       interpolation='none', origin='lower', extent=extent)
-                       
-        
-        # @todo    this fig.colorbar() will recursively die
-        # fig.colorbar(im, cax=cax, orientation='vertical')
-    else:
-        # now broken after using extent=
-        im = ax.imshow(d,cmap=kwargs['cmap'],  # norm=norm, vmin=vmin, vmax=vmax,
-                       interpolation='none', origin='lower', extent=extent)
-        x = np.arange(d.shape[0])
-        y = np.arange(d.shape[1])
-        cs = ax.contour(x,y,d,extent=extent)
-                       
+    # the image, colorbar and title are made once and updated in place
+    shown = (frame, extent)
+    redraw = extent != full_extent
+    if redraw:
+        # a new slice, zoom out to all of it
+        full_extent = extent
+        ax.set_xlim(extent[0], extent[1])
+        ax.set_ylim(extent[2], extent[3])
+    show_level()
+
     if not xlim and args.fix: # just need to check one since its either both or none
         xlim = ax.get_xlim()
         ylim = ax.get_ylim()
-    ax.set_title(f'{zvar}  Time: {float(time)}', loc='left')
-    ax.set_xlabel('x')
-    ax.set_ylabel('y')
+    title.set_text(f'{zvar}  Time: {float(time)}')
+    draw_frame(redraw)
+
+# draw the part of the shown frame that is inside the axes, from the
+# pyramid level that has about one cell per screen pixel
+def show_level():
+    d, extent = image_view(*shown)
+    im.set_data(d)
+    im.set_extent(extent)
+    im.set_clim(*color_limits(d))
+
+# the level and the crop of it that cover the visible part of the slice,
+# with the extent of that crop
+def image_view(frame, extent):
+    full = frame[zvar]
+    ny, nx = full.shape
+    x0, x1, y0, y1 = extent
+    vx0, vx1 = np.clip(sorted(ax.get_xlim()), x0, x1)
+    vy0, vy1 = np.clip(sorted(ax.get_ylim()), y0, y1)
+    box = ax.get_window_extent()
+    # the coarsest level that still has a cell per pixel
+    k = 0
+    while (nx * (vx1 - vx0) / (x1 - x0) / 2 ** (k + 1) >= box.width and
+           ny * (vy1 - vy0) / (y1 - y0) / 2 ** (k + 1) >= box.height and
+           k + 1 < frame.get('levels', np.inf)):
+        k += 1
+    level = image_level(frame, k)
+    dx = (x1 - x0) / nx * 2 ** k
+    dy = (y1 - y0) / ny * 2 ** k
+    i0 = int(np.clip(np.floor((vx0 - x0) / dx), 0, level.shape[1] - 1))
+    i1 = int(np.clip(np.ceil((vx1 - x0) / dx), i0 + 1, level.shape[1]))
+    j0 = int(np.clip(np.floor((vy0 - y0) / dy), 0, level.shape[0] - 1))
+    j1 = int(np.clip(np.ceil((vy1 - y0) / dy), j0 + 1, level.shape[0]))
+    return level[j0:j1, i0:i1], [x0 + i0 * dx, min(x1, x0 + i1 * dx),
+                                 y0 + j0 * dy, min(y1, y0 + j1 * dy)]
+
+# level k of the pyramid of zvar; frames from a store have no pyramid and
+# take every 2**k-th cell instead
+def image_level(frame, k):
+    if k == 0:
+        return frame[zvar]
+    key = '%s.%d' % (zvar, k)
+    if key in frame:
+        return frame[key]
+    return frame[zvar][::2 ** k, ::2 ** k]
+
+# zooming and panning pick the level and crop again, the toolbar redraws
+def on_zoom(axes):
+    if shown is not None:
+        show_level()
+
+# vmin/vmax if given, else with --fix the range of the variable over the
+# whole run once it is known, else like imshow the range of the visible part of this frame
+def color_limits(d):
+    lim = run_limits(zvar) if args.fix else None
+    if lim is None:
+        lim = (np.nanmin(d), np.nanmax(d))
+    return (kwargs['vmin'] if kwargs['vmin'] is not None else lim[0],
+            kwargs['vmax'] if kwargs['vmax'] is not None else lim[1])
+
+# range of a variable over all frames, None while it is still being found
+def run_limits(var):
+    if store is None:
+        return limits.limits(var)
+    if var not in store_limits:
+        # a strided pass over the memory-mapped frames
+        values = store[var].reshape(-1)
+        if percentiles is None:
+            store_limits[var] = (np.nanmin(values), np.nanmax(values))
+        else:
+            sample = values[::max(1, values.size // (1 << 20))]
+            store_limits[var] = tuple(np.nanpercentile(sample, percentiles))
+    return store_limits[var]
+
+# show the current image, colorbar and title, blitting them over the saved
+# background unless the axes changed and the whole figure has to be drawn again
+def draw_frame(redraw):
+    if redraw or args.noblit or background is None or not fig.canvas.supports_blit:
+        fig.canvas.draw_idle()
+        return
+    fig.canvas.restore_region(background)
+    draw_animated(fig.canvas.get_renderer())
+    fig.canvas.blit(fig.bbox)
+
+# draw the artists that full draws leave out
+def draw_animated(renderer):
+    im.draw(renderer)
+    title.draw(renderer)
+    cax.draw(renderer)
+    if fax is not None:
+        fax.draw(renderer)
+
+# save the figure without the animated artists after every full draw of
+# the window; saving to a file draws them into the file as well
+def on_draw(event):
+    global background
+    if args.noblit:
+        return
+    if event.canvas is canvas and canvas.supports_blit and not canvas.is_saving():
+        background = canvas.copy_from_bbox(fig.bbox)
+    draw_animated(event.renderer)
 
 # hard-pauses the animation
 # that is, the only way to unpause is by using the play or restart button
@@ -99,10 +191,12 @@ def play(self=None):
 def pause(self=None):
     global is_playing, fig
     if is_playing:
-        fig.canvas.stop_event_loop()
+        timer.stop()
         is_playing = False
 
 # plays the animation (either starts or resumes)
+# frames are advanced by a timer of the canvas rather than a blocking loop,
+# so several viewers can play at once in one process (see viewer.py)
 def resume(self=None):
     global is_playing, current_frame, ax, length, frame_sliding, hard_paused
     if not is_playing:
@@ -110,15 +204,26 @@ def resume(self=None):
         is_playing = True
         hard_paused = False
         #bpause.color = '0.85'
-        while current_frame < length and is_playing:
-            animate(current_frame)
-            current_frame += 1
-            fig.canvas.draw_idle()
-            fig.canvas.start_event_loop(delay)
-            frame_sliding = False
-            fslider.set_val(current_frame)
+        timer.interval = max(int(delay * 1000), 1)
+        timer.start()
+
+# shows the next frame, called by the playback timer
+def step():
+    global is_playing, current_frame, frame_sliding
+    if not is_playing:
+        return
+    if current_frame < length:
+        current_frame += 1
+        frame_sliding = False
+        # move the slider without calling update_fslider, it is drawn with the frame
+        fslider.eventson = False
+        fslider.set_val(current_frame)
+        fslider.eventson = True
+        animate(current_frame - 1)
+    if current_frame >= length:
+        timer.stop()
         is_playing = False
-        if loop and current_frame == length:
+        if loop:
             restart()
 
 # loops the animation
@@ -141,17 +246,14 @@ def restart(self=None):
 # select the variable
 def select_v(label):
     global current_frame, xcol, xlim, zvar
+    print('select_v',label)
+    zvar = label
     update_cols(xcol, label)
     if not hard_paused:
         restart()
     else:
         xlim = None
         animate(current_frame)
-        fig.canvas.draw_idle()
-    print('select_v',label)
-    zvar = label
-    kwargs['variable'] = zvar
-    reload_data()
 
 def update_cols(x, y):
     global xcol, ycol, ixcol, iycol
@@ -163,6 +265,7 @@ def update_cols(x, y):
 def update_delay(x):
     global delay
     delay = x / 1000
+    timer.interval = max(int(x), 1)
     #  something odd about setting the delay
     # print("DELAY:",delay)
 
@@ -170,7 +273,6 @@ def update_fslider(n):
     global frame_sliding, current_frame
     current_frame = n
     animate(current_frame - 1)
-    fig.canvas.draw_idle()
 
 '''def fix_axes(v):
     global xlim, ylim
@@ -187,27 +289,44 @@ def mouse_moved(e):
 
 def reload_data():
     global data
-    print("Reading %d data-frames for %s" % (length,zvar))
-    for i in range(len(f)):
-        data[i] = athena_read.bin(f[i],False,**kwargs)
+    print("Reading %d data-frames on demand" % length)
+    # frames are decoded when shown, a few are read ahead in the background,
+    # each with the image pyramids the viewer draws from
+    data = athena_read.FrameCache(athena_read.bin_pyramid, f, cache=True, **kwargs)
     
 
 argparser = ArgumentParser(description='plots the athena tab files specified')
 argparser.add_argument('-d', '--dir', help='the athena run directory containing tab/ or *.tab files', required=True)
 argparser.add_argument('-n', '--name', help='name of the problem being plotted') # primarily just used by the other gui
-argparser.add_argument('-f', '--fix', action='store_true', help='fixes the x and y axes of the animation based on the animation\'s first frame')
+argparser.add_argument('-f', '--fix', action='store_true', help='fixes the color range to that of the variable over all frames, found in the background')
+argparser.add_argument('--percentile', type=float, default=None, help='with --fix, use the P and 100-P percentiles of the frames instead of their extremes')
+argparser.add_argument('--dimension', default='z', choices=['x', 'y', 'z'], help='axis normal to the slice (default z)')
+argparser.add_argument('--location', type=float, default=0.0, help='position of the slice along that axis (default 0)')
+argparser.add_argument('--noblit', action='store_true', help='redraw the whole figure for every frame instead of blitting')
 args = argparser.parse_args()
+kwargs['dimension'] = args.dimension
+kwargs['location'] = args.location
 
-f = glob.glob(args.dir + '/bin/*.bin')
-f.sort()
+f = athena_read.run_files(args.dir, 'bin')
 length = len(f)
 
 if length==0:
     print("No bin data found")
     sys.exit(0)
 
-data = list(range(len(f)))
-reload_data()
+# a columnar store made by store_run.py for this slice replaces reading the frames
+store = athena_read.open_store(args.dir, 'bin', kwargs['dimension'], kwargs['location'])
+if store is None:
+    reload_data()
+else:
+    print("Using the bin store of %s" % args.dir)
+
+# color limits over the whole run for --fix
+percentiles = None if args.percentile is None else (args.percentile, 100 - args.percentile)
+limits = None
+store_limits = {}
+if args.fix and store is None:
+    limits = athena_read.FrameLimits(athena_read.bin, f, percentiles, **kwargs)
 
 
 #print('DEBUG: %s has %d files' % (fnames,len(f)))
@@ -242,6 +361,8 @@ iycol = 0
 
 # plotting configuration
 fig, ax = plt.subplots()
+# the window canvas, savefig() swaps fig.canvas for that of the file format
+canvas = fig.canvas
 fig.subplots_adjust(left=left, bottom=bottom, top=top) # old bottom was 0.34
 divider = make_axes_locatable(ax)
 cax = divider.append_axes('right', size='5%', pad=0.05)
@@ -249,6 +370,29 @@ sax = ax.secondary_xaxis('bottom')
 # plt.rcParams['font.family'] = 'Arial'
 # pause on close otherwise we might freeze
 fig.canvas.mpl_connect('close_event', pause)
+# drives the playback, see resume()
+timer = fig.canvas.new_timer(interval=int(delay * 1000))
+timer.add_callback(step)
+# artists updated by animate(), drawn by blitting; the colorbar follows the
+# image, its whole axes is animated so old tick labels are not left behind
+im = ax.imshow(np.zeros((1, 1)), cmap=kwargs['cmap'], interpolation='none', origin='lower',
+               animated=not args.noblit)
+cbar = fig.colorbar(im, cax=cax, orientation='vertical')
+# the image only covers the visible crop, the axes keep the slice limits
+ax.set_autoscale_on(False)
+ax.callbacks.connect('xlim_changed', on_zoom)
+ax.callbacks.connect('ylim_changed', on_zoom)
+shown = None
+full_extent = None
+cax.set_animated(not args.noblit)
+title = ax.set_title('', loc='left')
+title.set_animated(not args.noblit)
+# the two axes in the plane of the slice
+_, h, v = athena_read.bin_slice_plane(kwargs['dimension'])
+ax.set_xlabel('xyz'[h - 1])
+ax.set_ylabel('xyz'[v - 1])
+background = None
+fax = None
 # fig.set_size_inches(10, 10)
 
 plt.get_current_fig_manager().set_window_title(args.name if args.name else f[0].split('.')[0])
@@ -301,6 +445,7 @@ if True:
     delay_slider.on_changed(update_delay)
 
     fax = fig.add_axes([0.18, 0.95, 0.65, 0.03])
+    fax.set_animated(not args.noblit)
     fslider = Slider(
         ax=fax,
         label='Frame',
@@ -311,9 +456,16 @@ if True:
     )
 
     fslider.on_changed(update_fslider)
+    # the slider is drawn with each frame instead of redrawing the figure
+    fslider.drawon = False
 
 
     # in order to pause the animation when using the frame slider
     fig.canvas.mpl_connect('motion_notify_event', mouse_moved)
 
-plt.show()
+# connected last, so the background is saved after the widgets drew themselves
+fig.canvas.mpl_connect('draw_event', on_draw)
+
+# viewer.py shows the windows of several viewers at once
+if __name__ == "__main__":
+    plt.show()
@@ -218,12 +218,10 @@ class MainWindow(qw.QMainWindow):
         else:
             folder = qw.QFileDialog.getExistingDirectory(self, "Select Problem Directory", "")
             if folder:
-                cmd1 = 'python plot1d.py  -d %s/tab' % folder
-                cmd2 = 'python plot1d.py  -d %s --hst' % folder
+                # one viewer process for the tab, hst and bin windows
+                cmd1 = 'python viewer.py  -d %s' % folder
                 print(cmd1)
-                print(cmd2)
                 Popen(cmd1.split())
-                Popen(cmd2.split())
 
     def help(self):
         w = HelpWindow()
@@ -253,15 +253,10 @@ class MainWindow(qw.QMainWindow):
             # @todo     solve when info['problem'] has spaces (as many do)
             #Popen(['python', 'plot1d.py', '-d', odir+'/tab',           '-n', info['problem']])
             #Popen(['python', 'plot1d.py', '-d', odir,         '--hst', '-n', info['problem'] + ' history'])
-            cmd1 = 'python plot1d.py  -d %s/tab -n tab' % (odir)
-            cmd2 = 'python plot1d.py  -d %s --hst -n history' % (odir)
-            cmd3 = 'python plot2d.py  -d %s -n bin' % (odir)            
+            # one viewer process for the tab, hst and bin windows
+            cmd1 = 'python viewer.py  -d %s' % (odir)
             print(cmd1)
-            print(cmd2)
-            print(cmd3)
             Popen(cmd1.split())
-            Popen(cmd2.split())
-            Popen(cmd3.split())
         else:
             w = DisplayWindow(cmd)
             self.windows.append(w)
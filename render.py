@@ -0,0 +1,216 @@
+#! /usr/bin/env python
+#
+#     render:    draw the frames of a run without a window, as a numbered PNG
+#                sequence or piped into a movie encoder
+#
+#     python render.py -d run1 -k tab -x x1v -y dens
+#     python render.py -d run1 -k bin -y dens --fix --pipe 'ffmpeg -y -f image2pipe -framerate 25 -i - dens.mp4'
+#
+import os
+import shlex
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+
+import athena_read
+
+
+# state of a rendering process, see init_worker()
+args = None
+files = None
+store = None
+limits = None
+canvas = None
+
+
+def init_worker(worker_args, worker_limits):
+    global args, files, store, limits
+    args = worker_args
+    limits = worker_limits
+    files = athena_read.run_files(args.dir, args.kind)
+    store = athena_read.open_store(args.dir, args.kind, args.dimension, args.location)
+
+
+# the figure and artists of this process, made once and updated per frame
+def setup_figure():
+    global canvas, ax, artist, title
+    fig = Figure(figsize=(args.width / args.dpi, args.height / args.dpi), dpi=args.dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    title = ax.set_title('', loc='left')
+    if args.kind == 'tab':
+        artist, = ax.plot([], [], '-')
+        ax.set_xlabel(args.xcol)
+        ax.set_ylabel(args.variable)
+    else:
+        artist = ax.imshow(np.zeros((1, 1)), cmap=args.cmap, interpolation='none', origin='lower')
+        fig.colorbar(artist, ax=ax, orientation='vertical')
+        # the two axes in the plane of the slice
+        _, h, v = athena_read.bin_slice_plane(args.dimension)
+        ax.set_xlabel('xyz'[h - 1])
+        ax.set_ylabel('xyz'[v - 1])
+
+
+def read_frame(i):
+    if args.kind == 'tab':
+        if store is not None:
+            return {args.xcol: store[args.xcol][i], args.variable: store[args.variable][i],
+                    'time': store['time'][i]}
+        return athena_read.tab(files[i], columns=[args.xcol, args.variable])
+    if store is not None:
+        return {args.variable: store[args.variable][i], 'time': store['time'][i],
+                'xlim': store['xlim'], 'ylim': store['ylim']}
+    return athena_read.bin_pyramid(files[i], variable=args.variable, dimension=args.dimension,
+                                   location=args.location, output_file=None, dtype='native')
+
+
+def draw_tab(d):
+    x = d[args.xcol]
+    y = d[args.variable]
+    width = max(int(ax.get_window_extent().width), 1)
+    artist.set_data(*athena_read.decimate_line(x, y, width))
+    if limits is not None:
+        ax.set_xlim(athena_read.padded_limits(limits[0], ax.margins()[0]))
+        ax.set_ylim(athena_read.padded_limits(limits[1], ax.margins()[1]))
+    else:
+        ax.relim()
+        ax.autoscale_view()
+
+
+def draw_bin(d):
+    v = args.variable
+    ny, nx = d[v].shape
+    box = ax.get_window_extent()
+    # the coarsest pyramid level that still has a cell per pixel
+    k = 0
+    while ('%s.%d' % (v, k + 1) in d and
+           nx / 2 ** (k + 1) >= box.width and ny / 2 ** (k + 1) >= box.height):
+        k += 1
+    image = d[v] if k == 0 else d['%s.%d' % (v, k)]
+    artist.set_data(image)
+    artist.set_extent([d['xlim'][0], d['xlim'][1], d['ylim'][0], d['ylim'][1]])
+    lim = limits if limits is not None else (np.nanmin(image), np.nanmax(image))
+    artist.set_clim(*lim)
+
+
+# Render frame i; returns the PNG when piping, else writes it to a file
+def render_frame(i):
+    if canvas is None:
+        setup_figure()
+    d = read_frame(i)
+    if args.kind == 'tab':
+        draw_tab(d)
+    else:
+        draw_bin(d)
+    title.set_text(f'{args.variable}  Time: {float(d["time"])}')
+    if args.pipe:
+        png = BytesIO()
+        canvas.print_png(png)
+        return png.getvalue()
+    canvas.print_png(args.output % i)
+    return None
+
+
+# Fixed axis or color limits over the whole run for --fix
+def run_limits():
+    if not args.fix:
+        return None
+    run_store = athena_read.open_store(args.dir, args.kind, args.dimension, args.location)
+    if run_store is not None:
+        def lim(col):
+            return float(np.nanmin(run_store[col])), float(np.nanmax(run_store[col]))
+    else:
+        if args.kind == 'tab':
+            scan = athena_read.FrameLimits(athena_read.tab, athena_read.run_files(args.dir, 'tab'),
+                                           columns=[args.xcol, args.variable])
+        else:
+            scan = athena_read.FrameLimits(athena_read.bin, athena_read.run_files(args.dir, 'bin'),
+                                           variable=args.variable, dimension=args.dimension,
+                                           location=args.location, output_file=None, dtype='native')
+        scan.wait()
+        lim = scan.limits
+    if args.kind == 'bin':
+        return lim(args.variable)
+    return lim(args.xcol), lim(args.variable)
+
+
+def main():
+    argparser = ArgumentParser(description='renders the tab or bin frames of an athena run to PNG files or a movie encoder')
+    argparser.add_argument('-d', '--dir', help='the athena run directory containing tab/ or bin/, or *.tab and *.bin files', required=True)
+    argparser.add_argument('-k', '--kind', default='bin', choices=['tab', 'bin'], help='which frames to render (default bin)')
+    argparser.add_argument('-x', '--xcol', default='x1v', help='horizontal column of tab frames (default x1v)')
+    argparser.add_argument('-y', '--variable', default='dens', help='tab column or bin variable to draw (default dens)')
+    argparser.add_argument('--dimension', default='z', choices=['x', 'y', 'z'], help='axis normal to the bin slice (default z)')
+    argparser.add_argument('--location', type=float, default=0.0, help='position of the bin slice along that axis (default 0)')
+    argparser.add_argument('-f', '--fix', action='store_true', help='use the axis or color range over all frames instead of that of each frame')
+    argparser.add_argument('--cmap', default='viridis', help='colormap of bin frames (default viridis)')
+    argparser.add_argument('-o', '--output', default=None, help='printf pattern of the PNG files (default frames/<variable>.%%05d.png)')
+    argparser.add_argument('--pipe', default=None, help='encoder command that reads the PNG frames on its standard input, e.g. "ffmpeg -f image2pipe -i - out.mp4"')
+    argparser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of rendering processes (default one per core)')
+    argparser.add_argument('--width', type=int, default=960, help='frame width in pixels (default 960)')
+    argparser.add_argument('--height', type=int, default=720, help='frame height in pixels (default 720)')
+    argparser.add_argument('--dpi', type=int, default=100, help='resolution of the text and lines (default 100)')
+    render_args = argparser.parse_args()
+
+    if render_args.output is None:
+        render_args.output = os.path.join('frames', render_args.variable + '.%05d.png')
+    nframes = len(athena_read.run_files(render_args.dir, render_args.kind))
+    if nframes == 0:
+        print("No %s data found" % render_args.kind)
+        sys.exit(0)
+    if not render_args.pipe:
+        os.makedirs(os.path.dirname(render_args.output) or '.', exist_ok=True)
+
+    init_worker(render_args, None)
+    render_limits = run_limits()
+    init_worker(render_args, render_limits)
+
+    encoder = None
+    if render_args.pipe:
+        encoder = subprocess.Popen(shlex.split(render_args.pipe), stdin=subprocess.PIPE)
+
+    t0 = time.time()
+    workers = max(1, min(render_args.workers or 1, nframes))
+    if workers == 1:
+        frames = map(render_frame, range(nframes))
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(workers, initializer=init_worker,
+                                   initargs=(render_args, render_limits))
+        # frames come back in order, with a few per worker in flight
+        frames = pool_frames(pool, nframes, 4 * workers)
+    try:
+        for i, png in enumerate(frames):
+            if encoder is not None:
+                encoder.stdin.write(png)
+            if (i + 1) % 100 == 0 or i + 1 == nframes:
+                print("%d/%d frames, %.1f sec" % (i + 1, nframes, time.time() - t0))
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if encoder is not None:
+            encoder.stdin.close()
+            encoder.wait()
+
+
+def pool_frames(pool, nframes, window):
+    pending = []
+    for i in range(nframes):
+        pending.append(pool.submit(render_frame, i))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+if __name__ == "__main__":
+    main()
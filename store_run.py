@@ -0,0 +1,24 @@
+#! /usr/bin/env python
+#
+#     store_run:    pack the tab and bin snapshots of a run directory into
+#                   columnar stores that plot1d and plot2d read directly
+#
+#     python store_run.py -d run1
+#
+import athena_read
+from argparse import ArgumentParser
+
+argparser = ArgumentParser(description='packs the tab and bin snapshots of an athena run directory into columnar stores')
+argparser.add_argument('-d', '--dir', help='the athena run directory containing tab/ and bin/, or *.tab and *.bin files', required=True)
+argparser.add_argument('--dimension', default='z', choices=['x', 'y', 'z'], help='axis normal to the stored bin slice (default z)')
+argparser.add_argument('--location', type=float, default=0.0, help='position of the stored bin slice along that axis (default 0)')
+argparser.add_argument('-w', '--workers', type=int, default=None, help='number of processes decoding the snapshots (default one per core)')
+args = argparser.parse_args()
+
+for kind in ('tab', 'bin'):
+    f = athena_read.run_files(args.dir, kind)
+    if len(f) == 0:
+        continue
+    path = athena_read.store_run(args.dir, kind, dimension=args.dimension, location=args.location,
+                                 workers=args.workers)
+    print("%d %s files stored in %s" % (len(f), kind, path))
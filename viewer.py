@@ -0,0 +1,49 @@
+#! /usr/bin/env python
+#
+#     viewer:    one process showing the tab, history and bin windows of a
+#                run, sharing matplotlib, the readers and the parsed-file cache
+#
+#     python viewer.py -d run1 -n linear_wave
+#
+import glob
+import os
+import runpy
+import sys
+from argparse import ArgumentParser
+
+import matplotlib.pyplot as plt
+
+import athena_read
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+argparser = ArgumentParser(description='shows the tab, hst and bin output of an athena run in one process')
+argparser.add_argument('-d', '--dir', help='the athena run directory', required=True)
+argparser.add_argument('-n', '--name', default=None, help='name of the problem being plotted')
+argparser.add_argument('-f', '--fix', action='store_true', help='passed on to the viewers, fixes their axes or colors over all frames')
+args = argparser.parse_args()
+
+name = args.name if args.name else os.path.basename(os.path.normpath(args.dir))
+views = []
+if len(athena_read.run_files(args.dir, 'tab')) > 0:
+    views.append(('plot1d.py', ['-d', args.dir, '-n', name + ' tab']))
+if len(glob.glob(args.dir + '/*.hst')) > 0:
+    views.append(('plot1d.py', ['-d', args.dir, '--hst', '-n', name + ' history']))
+if len(athena_read.run_files(args.dir, 'bin')) > 0:
+    views.append(('plot2d.py', ['-d', args.dir, '-n', name + ' bin']))
+if len(views) == 0:
+    print("No tab, hst or bin data found in %s" % args.dir)
+    sys.exit(0)
+
+# each viewer script runs in its own namespace and leaves its window open,
+# the namespaces are kept so their widgets and callbacks stay alive; the
+# style a script sets (plot1d uses ggplot) only applies to its own window
+namespaces = []
+for script, script_args in views:
+    if args.fix:
+        script_args = script_args + ['--fix']
+    sys.argv = [script] + script_args
+    with plt.rc_context():
+        namespaces.append(runpy.run_path(os.path.join(here, script), run_name='athena_viewer'))
+
+plt.show()